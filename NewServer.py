@@ -4,21 +4,43 @@ import sys
 import os
 import json
 execfile('newSearch.py')
-from config import port
+from config import port, maxWaitMs, prefetchEnabled, responseMaxAge, maxTileZoom, tileCacheBytes, maxTimeSeriesCells
+from config import maxBatchQueries
 import math
 
 from flask import Flask
 from flask import request
+from flask import Response
 from flask.ext.cors import CORS, cross_origin
 from loadManager import DataManager
+from prefetch import Prefetcher
+from datasetFile import packBlock
+from compression import chooseEncoding, compressBody, compressChunks, PrecompressedCache
+from responseCache import ResponseCache, makeETag
+from tiles import resolutionForZoom, isValidTile, renderTile
+from aggregates import getHistogramBins
+from delta import formatSpans
+from polygons import GeometryError
+
+#
+# The response headers which carry the metadata for binary /get_data responses
+#
+binaryMetadataHeaders = ['X-SW-Lat', 'X-SW-Lon', 'X-Pts-Per-Row', 'X-Rows', 'X-Pts-Per-Degree', 'X-Res', 'X-Requested-Res', 'X-Stride',
+                         'X-Planned-Res']
 
 app = Flask(__name__)
-cors = CORS(app)
+cors = CORS(app, expose_headers=binaryMetadataHeaders)
 app.config['CORS_HEADERS'] = 'Content-Type'
 dataManager = DataManager()
+prefetcher = Prefetcher(dataManager)
+if prefetchEnabled: dataManager.addAccessListener(prefetcher)
+precompressedCache = PrecompressedCache()
+responseCache = ResponseCache()
+tileCache = ResponseCache(tileCacheBytes)
 
 #
-# Dig out a  field, convert it using convertFunction, and check the result
+# Dig out a  field from args (the request's arguments, or any dictionary),
+# convert it using convertFunction, and check the result
 # using checkFunction.  convertFunction should be something which takes a string
 # and returns the right type, throwing a ValueError if there is a problem.  checkFunction
 # takes a single parameter and returns True if it's valid, False otherwise.  Annotates
@@ -28,9 +50,9 @@ dataManager = DataManager()
 #
 
 
-def getField(request, requestResult, fieldName, convertFunction, checkFunction):
-    value = request.args.get(fieldName)
-    if (not value):
+def getField(args, requestResult, fieldName, convertFunction, checkFunction):
+    value = args.get(fieldName)
+    if (value is None or value == ''):
         requestResult['error'] = True
         requestResult['message'] += 'fieldName %s missing.  ' % fieldName
     try:
@@ -50,9 +72,12 @@ def getField(request, requestResult, fieldName, convertFunction, checkFunction):
 # provided as arguments
 #
 def parseRequest(request, fields):
+    return parseArgs(request.args, fields)
+
+def parseArgs(args, fields):
     result = {'error': False, 'message': ''}
     for (fieldName, conversion, checkFunction) in fields:
-        getField(request, result, fieldName, conversion, checkFunction)
+        getField(args, result, fieldName, conversion, checkFunction)
     return result
 
 basicParseFields = [('year', int, lambda x: x in range(1997, 2016)),
@@ -67,6 +92,19 @@ fullParseFields = basicParseFields + [
         ('seLon', float, lambda x: x <= 180.0 and x >= -180.0),
     ]
 
+resParseField = ('res', int, lambda x: x in [1, 2, 4, 10])
+
+baseParseFields = [('baseYear', int, lambda x: x in range(1997, 2016)),
+          ('baseMonth', int, lambda x: x in range(1, 13))
+          ]
+
+pointParseFields = [resParseField,
+        ('lat', float, lambda x: x <= 90.0 and x >= -90.0),
+        ('lon', float, lambda x: x <= 180.0 and x >= -180.0),
+    ]
+
+bboxParseFields = [resParseField] + fullParseFields[3:]
+
 #
 #  Turn a structure into a string
 #
@@ -88,7 +126,10 @@ def test_full():
         return json.dumps(result)
 
 def parseAndCheck(request):
-    query = parseRequest(request, fullParseFields)
+    return parseAndCheckArgs(request.args)
+
+def parseAndCheckArgs(args):
+    query = parseArgs(args, fullParseFields)
     if query['error']:
         query['message'] = 'Error in request ' + query['message']
         return query
@@ -111,6 +152,224 @@ def convertDegreesToTenthsOfDegrees(query, fields):
     for field in fields:
         query[field] = int(math.floor(query[field] * 10))
 
+#
+# The optional wait=<ms> argument: how long to wait for the requested resolution
+# to load before serving the best loaded resolution instead.  Defaults to 0 (don't
+# wait), and is capped at maxWaitMs
+#
+def getWaitMs(request):
+    try:
+        waitMs = int(request.args.get('wait', 0))
+    except ValueError:
+        waitMs = 0
+    return min(max(waitMs, 0), maxWaitMs)
+
+#
+# The optional maxPoints=<n> argument: the most cells the client wants back.  The
+# server picks the resolution and stride to stay within it (see planLevelOfDetail
+# in newSearch).  None if it isn't given or isn't a positive number
+#
+def getMaxPoints(args):
+    try:
+        maxPoints = int(args.get('maxPoints'))
+    except (ValueError, TypeError):
+        return None
+    return maxPoints if maxPoints > 0 else None
+
+#
+# Does the client want the binary format?  Either format=binary, or an Accept
+# header which prefers application/octet-stream to JSON
+#
+def wantsBinary(request):
+    if 'format' in request.args: return request.args.get('format') == 'binary'
+    return request.accept_mimetypes.best_match(['application/json', 'application/octet-stream']) == 'application/octet-stream'
+
+#
+# The headers carrying the metadata of a binary /get_data response.  The body is
+# the cells, packed four to three bytes in row-major order (the end padded to a
+# whole group), which packBlock gives
+#
+def getBinaryHeaders(result):
+    return dict(zip(binaryMetadataHeaders, [str(result['swCorner']['lat']), str(result['swCorner']['lon']),
+                                            str(result['pointsPerRow']), str(result['values'].shape[0]),
+                                            str(result['pointsPerDegree']), str(result['res']), str(result['requestedRes']),
+                                            str(result.get('stride', 1)), str(getPlannedRes(result))]))
+
+#
+# Send a data response.  entry is (body, mimetype, headers).  A response with an
+# etag (one at the planned resolution) may be cached by the client and proxies;
+# one served at a fallback resolution must not be, since it will change once the
+# planned resolution loads
+#
+def makeDataResponse(entry, etag):
+    (body, mimetype, headers) = entry
+    headers = dict(headers)
+    headers['Vary'] = 'Accept, Accept-Encoding'
+    if etag is None:
+        headers['Cache-Control'] = 'no-store'
+    else:
+        headers['ETag'] = '"%s"' % etag
+        headers['Cache-Control'] = 'public, max-age=%d' % responseMaxAge
+    return Response(body, mimetype=mimetype, headers=headers)
+
+#
+# Compress an entry (body, mimetype, headers) with encoding (None for none).
+# Returns the entry as sent and the encoding used, None if the body was left
+# as it was
+#
+def compressEntry(entry, encoding):
+    (body, mimetype, headers) = entry
+    (body, usedEncoding) = compressBody(body, encoding)
+    headers = dict(headers)
+    if usedEncoding is not None: headers['Content-Encoding'] = usedEncoding
+    return ((body, mimetype, headers), usedEncoding)
+
+#
+# A JSON response which isn't cached (the POST routes), compressed if the client
+# allows it
+#
+def makeUncachedJSONResponse(fields):
+    return makeDataResponse(compressEntry((json.dumps(fields), 'application/json', {}), chooseEncoding(request))[0], None)
+
+#
+# The 304 for a client whose copy has etag
+#
+def makeNotModified(etag):
+    return Response(status=304, headers={'ETag': '"%s"' % etag, 'Vary': 'Accept, Accept-Encoding',
+                                         'Cache-Control': 'public, max-age=%d' % responseMaxAge})
+
+#
+# The resolution a search is planned at: the requested one, or with maxPoints the
+# one planLevelOfDetail picks.  A result served below it (or which the search
+# marks as a 'fallback') isn't cached; one served at it is complete, even if that
+# is below requestedRes
+#
+def getPlannedRes(result):
+    return result.get('plannedRes', result['requestedRes'])
+
+def isComplete(result):
+    return result['res'] == getPlannedRes(result) and not result.get('fallback', False)
+
+def planQuery(query, maxPoints):
+    if maxPoints is None: return query['res']
+    return planLevelOfDetail(dataManager, query['year'], query['month'], query['res'],
+                             query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], maxPoints)[0]
+
+#
+# Serve a data request.  makeBody() does the search and returns (result, body,
+# mimetype, headers), the uncompressed response; route and extras (the route's
+# own arguments which change the body) with the normalized query make up the
+# cache key.  In order we try: the client's copy (If-None-Match, giving a 304),
+# the precompressed cache (for the common views), the response cache, and only
+# then makeBody.  Requests answered from a cache still record their access, so
+# popularity and prefetching see them.  plannedRes (see planQuery) is the
+# resolution the data set version, and so the ETag, is taken at
+#
+def serveData(route, query, extras, makeBody, plannedRes = None):
+    (year, month, res) = (query['year'], query['month'], plannedRes or query['res'])
+    key = (route, year, month, query['res'], query['nwLat'], query['seLat'], query['nwLon'], query['seLon']) + extras
+    version = dataManager.getVersion(year, month, res)
+    encoding = chooseEncoding(request)
+    for etag in set([makeETag(key, version, encoding), makeETag(key, version)]):
+        if request.if_none_match.contains(etag):
+            dataManager.recordAccess(year, month, res)
+            return makeNotModified(etag)
+    compressedKey = key + (encoding,) if encoding is not None and precompressedCache.isCommonView(query) else None
+    entry = precompressedCache.get(compressedKey) if compressedKey else None
+    if entry is not None:
+        dataManager.recordAccess(year, month, res)
+        return makeDataResponse(entry, makeETag(key, version, encoding))
+    entry = responseCache.get(key)
+    if entry is not None:
+        dataManager.recordAccess(year, month, res)
+        complete = True
+    else:
+        (result, body, mimetype, headers) = makeBody()
+        entry = (body, mimetype, headers)
+        complete = isComplete(result)
+        if complete: responseCache.put(key, *entry)
+    (entry, usedEncoding) = compressEntry(entry, encoding)
+    if complete and compressedKey and usedEncoding is not None:
+        precompressedCache.put(compressedKey, *entry)
+    return makeDataResponse(entry, makeETag(key, version, usedEncoding) if complete else None)
+
+#
+# Streamed responses.  With stream=1 the data routes send the JSON envelope, then
+# the data a chunk of rows at a time as it is read (see streamDB), so the memory
+# a request takes and the time to the first byte don't grow with the box.
+# Streaming is for the plain responses: with maxPoints, binary or merge the
+# response is built whole as usual.  Streamed responses bypass the response
+# caches and have no ETag
+#
+def wantsStream(request):
+    return request.args.get('stream') in ['1', 'true', 'yes']
+
+#
+# Send fields as JSON, with one more field, key, a string made up of chunks
+# (which must need no escaping in JSON), compressed as it goes if the client
+# accepts it
+#
+def makeStreamedResponse(result, fields, key, chunks):
+    envelope = json.dumps(fields)
+    def generate():
+        yield envelope[:-1] + ', "%s": "' % key
+        for chunk in chunks: yield chunk
+        yield '"}'
+    encoding = chooseEncoding(request)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if isComplete(result):
+        headers['Cache-Control'] = 'public, max-age=%d' % responseMaxAge
+    else:
+        headers['Cache-Control'] = 'no-store'
+    if encoding is not None: headers['Content-Encoding'] = encoding
+    return Response(compressChunks(generate(), encoding), mimetype='text/html', headers=headers)
+
+def getStreamFields(result):
+    return {'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'], 'ptsPerDegree': result['pointsPerDegree'],
+            'res': result['res'], 'requestedRes': result['requestedRes'], 'stride': 1,
+            'plannedRes': getPlannedRes(result)}
+
+def getReadableChunks(result):
+    for (row, values) in iterateRowChunks(result):
+        yield ('\\n' if row > 0 else '') + '\\n'.join([encodeSymbols(rowValues) for rowValues in values])
+
+def getRectangleChunks(result, indicesOnly):
+    separator = ''
+    for (row, values) in iterateRowChunks(result):
+        rectangles = formatRectangles(getRectangleArray(dict(result, values=values), indicesOnly, None, row))
+        if not rectangles: continue
+        yield separator + rectangles
+        separator = ','
+
+#
+# The responses of the data routes (and of the queries in a batch), as
+# dictionaries, from the search results
+#
+def getDataFields(result):
+    return {'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'],
+            'ptsPerDegree': result['pointsPerDegree'], 'base64String': encodeSymbols(result['values']),
+            'res': result['res'], 'requestedRes': result['requestedRes'], 'stride': result.get('stride', 1),
+            'plannedRes': getPlannedRes(result)}
+
+def getReadableFields(result):
+    return {'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'],
+            'ptsPerDegree': result['pointsPerDegree'], 'base64String': '\n'.join(result['sequences']),
+            'res': result['res'], 'requestedRes': result['requestedRes'], 'stride': result.get('stride', 1),
+            'plannedRes': getPlannedRes(result)}
+
+def getRectangleFields(searchResult, indicesOnly, merge):
+    result = getRectangleArray(searchResult, indicesOnly, merge)
+    return {'sw': searchResult['swCorner'],
+            'ptsPerDegree': searchResult['pointsPerDegree'], 'rectangles': formatRectangles(result),
+            'res': searchResult['res'], 'requestedRes': searchResult['requestedRes'], 'merge': merge,
+            'stride': searchResult.get('stride', 1), 'plannedRes': getPlannedRes(searchResult)}
+
+def getAggregateFields(result):
+    return {'sw': result['swCorner'], 'ptsPerDegree': result['pointsPerDegree'],
+            'cells': result['cells'], 'sum': result['sum'], 'mean': result['mean'], 'nonzero': result['nonzero'],
+            'histogram': result['histogram'], 'histogramBins': getHistogramBins(),
+            'res': result['res'], 'requestedRes': result['requestedRes']}
+
 @app.route('/get_time')
 def get_times():
     query = parseAndCheck(request)
@@ -129,21 +388,281 @@ def get_inventory():
     print inventory
     size = '\nTotal Bytes loaded: %dMB\n' % int(round(dataManager.getSize()/1.0E6))
     print size
-    return loadable + '\nData sets loaded\n' + inventory + size
+    return 'Manifest version %s\n' % dataManager.getManifestVersion() + loadable + '\nData sets loaded\n' + inventory + size
 
-@app.route('/get_data')
-def get_data():
+#
+# Readiness and health, for the load balancer.  /ready is 200 once the warm-up
+# (every data set below res 10) has finished loading and 503 before that; /healthz
+# is 200 whenever the server is up, and gives the manifest version too.  Both
+# report the warm-up progress
+#
+@app.route('/ready')
+def get_ready():
+    status = dataManager.getWarmUpStatus()
+    return (json.dumps(status), 200 if status['ready'] else 503, {'Content-Type': 'application/json'})
+
+@app.route('/healthz')
+def get_health():
+    status = {'status': 'ok', 'manifestVersion': dataManager.getManifestVersion(), 'warmUp': dataManager.getWarmUpStatus(),
+              'loadQueueDepth': dataManager.getLoaderStats()['queueDepth']}
+    return (json.dumps(status), 200, {'Content-Type': 'application/json'})
+
+@app.route('/loader_stats')
+def get_loader_stats():
+    return json.dumps(dataManager.getLoaderStats())
+
+@app.route('/prefetch_stats')
+def get_prefetch_stats():
+    return json.dumps(prefetcher.getStats())
+
+@app.route('/compression_stats')
+def get_compression_stats():
+    return json.dumps(precompressedCache.getStats())
+
+#
+# A map tile, rendered from the data set at the resolution for the zoom.  Tiles
+# are cached and carry ETags like the data responses; a tile rendered from a
+# fallback resolution is neither cached nor cacheable
+#
+@app.route('/tiles/<int:year>/<int:month>/<int:z>/<int:x>/<int:y>.png')
+def get_tile(year, month, z, x, y):
+    if z > maxTileZoom or not isValidTile(z, x, y):
+        return ('Error in request no tile %d/%d/%d, zoom must be at most %d' % (z, x, y, maxTileZoom), 404)
+    res = resolutionForZoom(z)
+    if not dataManager.checkLoadable(year, month, res):
+        return ('Dataset %s is not loaded' % convertToString(year, month, res), 404)
+    key = ('tiles', year, month, res, z, x, y)
+    etag = makeETag(key, dataManager.getVersion(year, month, res))
+    dataManager.recordAccess(year, month, res)
+    if request.if_none_match.contains(etag):
+        return makeNotModified(etag)
+    entry = tileCache.get(key)
+    if entry is None:
+        (servedRes, dataset) = getBestAvailableData(dataManager, year, month, res, getWaitMs(request))
+        entry = (renderTile(dataset, servedRes, z, x, y), 'image/png', {})
+        if servedRes != res:
+            return makeDataResponse(entry, None)
+        tileCache.put(key, *entry)
+    return makeDataResponse(entry, etag)
+
+#
+# The cells of the box which changed since (baseYear, baseMonth), as spans over
+# the row-major index space of get_data_readable.  The client must hold the base
+# month at the res (and stride) this response gives, which is always the planned
+# res: while either month isn't loaded at it the response is an error, not a
+# delta at some other res.  The ETag covers the versions of both data sets
+#
+@app.route('/get_data_delta')
+def get_data_delta():
     query = parseAndCheck(request)
     if (query['error']):
         return query['message']
+    base = parseRequest(request, baseParseFields)
+    if base['error']:
+        return 'Error in request ' + base['message']
+    (baseYear, baseMonth) = (base['baseYear'], base['baseMonth'])
     convertDegreesToTenthsOfDegrees(query, degreeFields)
-    result = searchDB(dataManager, query['year'], query['month'], query['res'],
-               query['nwLat'], query['seLat'], query['nwLon'], query['seLon'])
+    maxPoints = getMaxPoints(request.args)
+    plannedRes = planQuery(query, maxPoints)
+    if not dataManager.checkLoadable(baseYear, baseMonth, plannedRes):
+        return "Dataset %s is not loaded" % convertToString(baseYear, baseMonth, plannedRes)
+    def makeBody():
+        result = searchDelta(dataManager, query['year'], query['month'], query['res'], baseYear, baseMonth,
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request), maxPoints)
+        if result['spans'] is None:
+            return (result, 'Error in request the data sets are not loaded at res %d yet, try again or use get_data' % plannedRes,
+                    'text/html', {})
+        (starts, stops) = result['spans']
+        return (result, json.dumps({
+            'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'], 'ptsPerDegree': result['pointsPerDegree'],
+            'res': result['res'], 'requestedRes': result['requestedRes'], 'stride': result.get('stride', 1),
+            'plannedRes': getPlannedRes(result), 'baseYear': baseYear, 'baseMonth': baseMonth, 'cells': result['values'].size,
+            'changed': result['changed'], 'spans': formatSpans(result['values'], starts, stops)
+        }), 'text/html', {})
+    baseVersion = dataManager.getVersion(baseYear, baseMonth, plannedRes)
+    return serveData('get_data_delta', query, (baseYear, baseMonth, baseVersion, maxPoints), makeBody, plannedRes)
+
+#
+# Sum, mean, nonzero count and histogram of the approximate values in a box
+#
+@app.route('/get_aggregate')
+def get_aggregate():
+    query = parseAndCheck(request)
+    if (query['error']):
+        return query['message']
+    convertDegreesToTenthsOfDegrees(query, degreeFields)
+    def makeBody():
+        result = searchAggregate(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request))
+        return (result, json.dumps(getAggregateFields(result)), 'text/html', {})
+    return serveData('get_aggregate', query, (), makeBody)
+
+#
+# Parse and check one query of a batch: the usual arguments and maxPoints, plus
+# kind (one of batchKinds, default 'data'), and for rectangles indicesOnly and merge.  Returns
+# the query, with its coordinates in tenths of degrees, or an error message
+#
+def parseBatchQuery(args):
+    if not isinstance(args, dict):
+        return 'Error in request a query must be a JSON object, not %s' % json.dumps(args)
+    argStrings = dict([(name, getArgString(value)) for (name, value) in args.items()])
+    query = parseAndCheckArgs(argStrings)
+    if query['error']:
+        return query['message']
+    query['kind'] = args.get('kind', 'data')
+    if not query['kind'] in batchKinds:
+        return 'Error in request kind must be one of %s, not %s' % (', '.join(batchKinds), query['kind'])
+    query['indicesOnly'] = bool(args.get('indicesOnly'))
+    query['maxPoints'] = getMaxPoints(argStrings)
+    query['merge'] = args.get('merge')
+    if query['merge'] is not None and not query['merge'] in mergeModes:
+        return 'Error in request merge must be one of %s, not %s' % (', '.join(mergeModes), query['merge'])
+    convertDegreesToTenthsOfDegrees(query, degreeFields)
+    return query
+
+#
+# A batch query's argument as it would be written in a query string, so it is
+# checked as the GET arguments are: a year of 2000.5 is refused, as year=2000.5
+# is, rather than truncated.  repr keeps every digit of a float, and strings and
+# anything which isn't a number are left as they are
+#
+def getArgString(value):
+    if isinstance(value, float): return repr(value)
+    if isinstance(value, (bool, int, long)): return str(value)
+    return value
+
+#
+# Many queries in one request: the body is a JSON list of queries (or an object
+# with the list as queries), each with the arguments of the route for its kind.
+# The queries are grouped by (year, month, res), so each data set is resolved
+# once.  The response has a result for each query, in order: what the route for
+# its kind would return, or {'error': message}
+#
+@app.route('/batch', methods=['POST'])
+def post_batch():
+    queries = request.get_json(force=True, silent=True)
+    if isinstance(queries, dict): queries = queries.get('queries')
+    if not isinstance(queries, list):
+        return 'Error in request the body must be a JSON list of queries'
+    if len(queries) > maxBatchQueries:
+        return 'Error in request %d queries, at most %d are allowed' % (len(queries), maxBatchQueries)
+    results = [None] * len(queries)
+    parsed = {}
+    for (i, args) in enumerate(queries):
+        query = parseBatchQuery(args)
+        if isinstance(query, dict): parsed[i] = query
+        else: results[i] = {'error': query}
+    keyOf = lambda query: (query['year'], query['month'], query['res'])
+    resolved = resolveDataSets(dataManager, [keyOf(query) for query in parsed.values()], getWaitMs(request))
+    for i in sorted(parsed.keys(), key = lambda i: keyOf(parsed[i])):
+        query = parsed[i]
+        try:
+            result = searchResolved(dataManager, keyOf(query), resolved[keyOf(query)], query['kind'],
+                                    query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], query['maxPoints'])
+            if query['kind'] == 'readable': results[i] = getReadableFields(result)
+            elif query['kind'] == 'rectangle': results[i] = getRectangleFields(result, query['indicesOnly'], query['merge'])
+            elif query['kind'] == 'aggregate': results[i] = getAggregateFields(result)
+            else: results[i] = getDataFields(result)
+        except Exception as e:
+            results[i] = {'error': 'Error in query %s' % e}
+    return makeUncachedJSONResponse({'results': results})
+
+#
+# The data inside a polygon.  year, month and res are arguments as usual and the
+# body is a GeoJSON Polygon or MultiPolygon, or a Feature or FeatureCollection of
+# them.  The response has spans, a list of [row, first column, base-64 string]
+# with the values of the cells of each run of the row inside the polygon (rows and
+# columns are grid indices, from the south pole and the dateline), or, with masked,
+# the block covering the polygon's bounding box as a base-64 string in which the
+# cells outside the polygon are 0
+#
+@app.route('/get_data_polygon', methods=['POST'])
+def post_data_polygon():
+    query = parseRequest(request, basicParseFields)
+    if query['error']:
+        return 'Error in request ' + query['message']
+    if not dataManager.checkLoadable(query['year'], query['month'], query['res']):
+        return "Dataset %s is not loaded" % convertToString(query['year'], query['month'], query['res'])
+    geoJSON = request.get_json(force=True, silent=True)
+    try:
+        result = searchPolygon(dataManager, query['year'], query['month'], query['res'], geoJSON, getWaitMs(request))
+    except GeometryError as e:
+        return 'Error in request %s' % e
+    (rows, firstCols, lastCols) = result['spans']
+    fields = {'ptsPerDegree': result['pointsPerDegree'], 'res': result['res'], 'requestedRes': result['requestedRes'],
+              'cells': len(result['spanValues'])}
+    if 'masked' in request.args:
+        fields.update({'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'], 'base64String': encodeSymbols(result['values'])})
+    else:
+        symbols = encodeSymbols(result['spanValues'])
+        ends = numpy.cumsum(lastCols - firstCols + 1).tolist()
+        fields['spans'] = [[row, firstCol, symbols[end - length:end]] for (row, firstCol, end, length)
+                           in zip(rows.tolist(), firstCols.tolist(), ends, (lastCols - firstCols + 1).tolist())]
+    return makeUncachedJSONResponse(fields)
+
+#
+# The symbol value of a cell (lat, lon), or of each cell in a small bounding box,
+# for every month at res.  series has a base64 string for each cell, in row-major
+# order from sw, with one symbol per month in months
+#
+@app.route('/get_timeseries')
+def get_timeseries():
+    isBox = 'nwLat' in request.args
+    query = parseRequest(request, bboxParseFields if isBox else pointParseFields)
+    if query['error']:
+        return 'Error in request ' + query['message']
+    res = query['res']
+    if not res in [aRes for (year, month, aRes) in dataManager.getLoadableKeys()]:
+        return 'Error in request no data sets at res %d' % res
+    if isBox:
+        convertDegreesToTenthsOfDegrees(query, degreeFields)
+        (numRows, numCols) = getBlockShape(query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], res)
+        numCells = numRows * numCols
+        if numCells == 0:
+            return 'Error in request the box has no cells'
+        if numCells > maxTimeSeriesCells:
+            return 'Error in request the box has %d cells, at most %d are allowed' % (numCells, maxTimeSeriesCells)
+        result = searchTimeSeries(dataManager, res, query['nwLat'], query['seLat'], query['nwLon'], query['seLon'])
+    else:
+        convertDegreesToTenthsOfDegrees(query, ['lat', 'lon'])
+        result = searchTimeSeriesAt(dataManager, res, query['lat'], query['lon'])
+    values = result['values']
+    series = [encodeSymbols(cell) for cell in values.reshape(-1, values.shape[2])] if values.size else []
     return json.dumps({
-        'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'],
-        'ptsPerDegree': result['pointsPerDegree'], 'base64String': result['base64String']
+        'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'], 'ptsPerDegree': result['pointsPerDegree'],
+        'res': res, 'months': [{'year': year, 'month': month} for (year, month) in result['months']],
+        'series': series, 'indexed': result['indexed']
     })
 
+@app.route('/tile_cache_stats')
+def get_tile_cache_stats():
+    return json.dumps(tileCache.getStats())
+
+@app.route('/response_cache_stats')
+def get_response_cache_stats():
+    return json.dumps(responseCache.getStats())
+
+@app.route('/get_data')
+def get_data():
+    query = parseAndCheck(request)
+    if (query['error']):
+        return query['message']
+    convertDegreesToTenthsOfDegrees(query, degreeFields)
+    binary = wantsBinary(request)
+    maxPoints = getMaxPoints(request.args)
+    if wantsStream(request) and maxPoints is None and not binary:
+        result = streamDB(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request))
+        chunks = (encodeSymbols(values) for (row, values) in iterateRowChunks(result))
+        return makeStreamedResponse(result, getStreamFields(result), 'base64String', chunks)
+    def makeBody():
+        result = searchDB(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request), maxPoints)
+        if binary:
+            return (result, packBlock(result['values']), 'application/octet-stream', getBinaryHeaders(result))
+        return (result, json.dumps(getDataFields(result)), 'text/html', {})
+    return serveData('get_data', query, (binary, maxPoints), makeBody, planQuery(query, maxPoints))
+
 @app.route('/test_query')
 def get_query():
     query = parseAndCheck(request)
@@ -158,12 +677,16 @@ def get_data_readable():
     if (query['error']):
         return query['message']
     convertDegreesToTenthsOfDegrees(query, degreeFields)
-    result = searchDBReturnRows(dataManager, query['year'], query['month'], query['res'],
-               query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], False)
-    return json.dumps({
-        'sw': result['swCorner'], 'ptsPerRow': result['pointsPerRow'],
-        'ptsPerDegree': result['pointsPerDegree'], 'base64String': '\n'.join(result['sequences'])
-    })
+    maxPoints = getMaxPoints(request.args)
+    if wantsStream(request) and maxPoints is None:
+        result = streamDB(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request))
+        return makeStreamedResponse(result, getStreamFields(result), 'base64String', getReadableChunks(result))
+    def makeBody():
+        result = searchDBReturnRows(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], False, getWaitMs(request), maxPoints)
+        return (result, json.dumps(getReadableFields(result)), 'text/html', {})
+    return serveData('get_data_readable', query, (maxPoints,), makeBody, planQuery(query, maxPoints))
 
 @app.route('/get_data_rectangle')
 def get_data_rectangle():
@@ -171,27 +694,77 @@ def get_data_rectangle():
     if (query['error']):
         return query['message']
     convertDegreesToTenthsOfDegrees(query, degreeFields)
-    searchResult = searchDBReturnRows(dataManager, query['year'], query['month'], query['res'],
-               query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], False)
     indicesOnly = 'indicesOnly' in request.args
-    result = convertToRectangles(searchResult, 'indicesOnly')
-    return json.dumps({
-        'sw': searchResult['swCorner'],
-        'ptsPerDegree': searchResult['pointsPerDegree'], 'rectangles': ','.join(result)
-    })
+    merge = request.args.get('merge')
+    if merge is not None and not merge in mergeModes:
+        return 'Error in request merge must be one of %s, not %s' % (', '.join(mergeModes), merge)
+    maxPoints = getMaxPoints(request.args)
+    if wantsStream(request) and maxPoints is None and merge is None:
+        result = streamDB(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request))
+        fields = getStreamFields(result)
+        del fields['ptsPerRow']
+        fields['merge'] = None
+        return makeStreamedResponse(result, fields, 'rectangles', getRectangleChunks(result, indicesOnly))
+    def makeBody():
+        searchResult = searchDB(dataManager, query['year'], query['month'], query['res'],
+                   query['nwLat'], query['seLat'], query['nwLon'], query['seLon'], getWaitMs(request), maxPoints)
+        return (searchResult, json.dumps(getRectangleFields(searchResult, indicesOnly, merge)), 'text/html', {})
+    return serveData('get_data_rectangle', query, (indicesOnly, merge, maxPoints), makeBody, planQuery(query, maxPoints))
 
 @app.route('/help')
 def print_help():
     str = '<p>/show_inventory: print loaded data'
     str += '<p>/get_data?&lt;args&gt;:get the data as a base-64 string with metadata.  See below for argument format'
+    str += '  With format=binary (or Accept: application/octet-stream) the cells are sent raw, packed four 6-bit cells to three bytes'
+    str += ' in row-major order, as application/octet-stream, with the metadata in the headers %s' % ', '.join(binaryMetadataHeaders)
     str += '<p>/get_data_readable?&lt;args&gt;:same as get_data but put the base64 string into rows for human readability'
     str += '<p>/get_times?&lt;args&gt;: get the statistics on the query'
     str += '<p>/get_query&lt;args&gt;: parse the query and return the parsed result, used for debugging'
     str += '<p>/get_data_rectangle?&lt;args&gt;: get the data as a set of 5-tuple rectangles rather than as a set of strings.  In addition to'
-    str += ' the usual args, if indicesOnly is given as an argument, gives row/column indices rather than lat/lon for coordinates'
+    str += ' the usual args, if indicesOnly is given as an argument, gives row/column indices rather than lat/lon for coordinates.'
+    str += '  merge=rows joins rectangles with the same value and columns in consecutive rows, and merge=greedy covers the data with'
+    str += ' rectangles grown greedily across rows; either way each rectangle gets a fifth entry, its last latitude (or row)'
+    str += '<p>/ready: 200 once the data sets below res 10 are loaded, 503 until then (or for good, if any of them'
+    str += ' failed to load: degraded is then true), with the warm-up progress'
+    str += '<p>/healthz: 200 while the server is up, with the manifest version and the warm-up progress'
+    str += '<p>/loader_stats: queue depth and load time statistics for the background loaders'
+    str += '<p>/prefetch_stats: hit rate and other statistics for prefetching of adjacent months and resolutions'
+    str += '<p>/compression_stats: hits, misses and size of the cache of compressed responses for the common views'
+    str += '<p>/response_cache_stats: hits, misses and size of the cache of data responses'
+    str += '<p>/tiles/&lt;year&gt;/&lt;month&gt;/&lt;z&gt;/&lt;x&gt;/&lt;y&gt;.png: the Web Mercator map tile z/x/y (zoom 0 to %d)' % maxTileZoom
+    str += ' for the month, colored by pollution level, rendered from the resolution suited to the zoom'
+    str += '<p>/get_data_delta?&lt;args&gt;&amp;baseYear=&lt;year&gt;&amp;baseMonth=&lt;1-12&gt;: the cells which differ from'
+    str += ' the base month, for a client which has the base month at the same res and stride.  spans is a list of'
+    str += ' [index, base-64 string]: the new values from that index on, in the row-major order of get_data'
+    str += '<p>/get_aggregate?&lt;args&gt;: the number of cells, the sum and mean of the approximate values (the midpoints'
+    str += ' of the ranges the symbols stand for), the number of nonzero cells and a histogram of the symbols, over the box'
+    str += '<p>/batch (POST): a JSON list of queries, each an object with the &lt;args&gt; below and kind, one of %s' % ', '.join(batchKinds)
+    str += ' (default data), which says which route it is a query for.  The response has results, a list with what that route'
+    str += ' would return for each query, or {"error": message}.  At most %d queries' % maxBatchQueries
+    str += '<p>/get_timeseries?res=&lt;res&gt;&amp;lat=&lt;latitude&gt;&amp;lon=&lt;longitude&gt;: the value of the cell at (lat, lon)'
+    str += ' for every month, as a base-64 string with one symbol per month.  Instead of lat and lon a small box (at most'
+    str += ' %d cells) may be given with seLon, nwLon, seLat and nwLat, which gives a string per cell' % maxTimeSeriesCells
+    str += '<p>/get_data_polygon?year=&lt;year&gt;&amp;month=&lt;1-12&gt;&amp;res=&lt;res&gt; (POST): the data inside the GeoJSON'
+    str += ' Polygon or MultiPolygon in the body (cells whose centres are inside it).  spans is a list of [row, column,'
+    str += ' base-64 string] for the runs of cells inside, in grid indices from the south pole and the dateline; with'
+    str += ' masked, base64String is the block covering the polygon with the cells outside it set to 0'
+    str += '<p>/tile_cache_stats: hits, misses and size of the cache of rendered tiles'
     str += '<p>/help: print this message\n'
     str += '&lt;args&gt;: seLon=&lt;longitude&gt;, nwLon=&lt;longitude&gt;, seLat=&lt;latitude&gt;, nwLat=&lt;latitude&gt;,'
     str += 'year=&lt;year&gt;, month=&lt;1-12&gt;, res=&lt;1,2,4, or 10&gt;'
+    str += '<p>Optionally, wait=&lt;ms&gt; waits up to ms milliseconds for res to load rather than serving the best loaded resolution.'
+    str += '  Responses give the resolution served as res and the one asked for as requestedRes'
+    str += '<p>Optionally, stream=1 streams get_data, get_data_readable and get_data_rectangle: the data is read and sent'
+    str += ' a chunk of rows at a time, for big boxes.  Not with maxPoints, format=binary or merge, which are sent whole'
+    str += '<p>Optionally, maxPoints=&lt;n&gt; caps the number of cells returned by get_data, get_data_readable and get_data_rectangle.'
+    str += '  The server picks the resolution (up to res), and if need be takes the max over blocks of stride x stride cells,'
+    str += ' to give the most points per degree within the cap.  Responses give the stride, and ptsPerDegree is res / stride.'
+    str += '  plannedRes is the resolution picked; a response with res below plannedRes is a fallback and is not cached'
+    str += '<p>get_data, get_data_readable and get_data_rectangle are compressed with gzip or deflate if the Accept-Encoding'
+    str += ' header allows it.  The compressed responses for the whole world and the continents are cached'
+    str += '<p>Responses at the requested resolution are cached, and carry an ETag and Cache-Control: a request with'
+    str += ' If-None-Match giving the ETag gets a 304 while the data set is unchanged'
     return str
 
 @app.route('/')
@@ -0,0 +1,104 @@
+#
+# Region aggregates over a data set: the sum and mean of the (approximate)
+# physical values, the number of nonzero cells and a histogram of the symbols,
+# over any block of cells.  Symbols are decoded to the midpoints of their
+# Base64Encoder.getXRange ranges.  The histogram bins are given by their lowest
+# symbols in aggregateHistogramBins; the first bin should be symbol 0 alone, and
+# the nonzero count comes from it.  Each loaded data set gets per-row prefix sums
+# of the statistics, taken every aggregateBlockColumns columns: the sums as
+# float64 and the bin counts as uint16 (a row has at most 3600 cells), so the
+# tables are smaller than the data set.  A block's statistics are then two
+# lookups per row for the whole column blocks it covers, plus the cells of the
+# partial column blocks at its ends, read from the data set
+#
+import numpy
+from mapping import Base64Encoder
+from config import encoderMaxX, encoderMaxY, aggregateHistogramBins, aggregateBlockColumns
+
+encoder = Base64Encoder(encoderMaxX, encoderMaxY)
+midpoints = encoder.getMidpoints()
+binStarts = numpy.array(aggregateHistogramBins)
+binEnds = numpy.append(binStarts[1:], 64)
+
+#
+# Rows of the grid read at a time while building the tables
+#
+buildRows = 64
+
+#
+# The histogram bin of each symbol value in values
+#
+def getBins(values):
+    return numpy.searchsorted(binStarts, values, side='right') - 1
+
+#
+# The symbol and value ranges of the histogram bins, for the response
+#
+def getHistogramBins():
+    return [{'symbols': [int(start), int(end) - 1], 'min': max(0, encoder.getXRange(int(start))['min']),
+             'max': encoder.getXRange(int(end) - 1)['max']} for (start, end) in zip(binStarts, binEnds)]
+
+class AggregateTables:
+    def __init__(self, dataset, blockColumns = aggregateBlockColumns):
+        self.dataset = dataset
+        (self.numRows, self.rowLength) = (dataset.numRows, dataset.rowLength)
+        self.blockColumns = blockColumns
+        self.numBlocks = self.rowLength / blockColumns
+        self.sums = numpy.zeros((self.numRows, self.numBlocks + 1), dtype=numpy.float64)
+        self.counts = numpy.zeros((len(binStarts), self.numRows, self.numBlocks + 1), dtype=numpy.uint16)
+        for firstRow in range(0, self.numRows, buildRows):
+            lastRow = min(firstRow + buildRows, self.numRows)
+            values = dataset.getBlock(firstRow, lastRow, 0, self.numBlocks * blockColumns)
+            values = values.reshape(lastRow - firstRow, self.numBlocks, blockColumns)
+            numpy.cumsum(midpoints[values].sum(axis=2), axis=1, out=self.sums[firstRow:lastRow, 1:])
+            bins = getBins(values)
+            for i in range(len(binStarts)):
+                numpy.cumsum((bins == i).sum(axis=2), axis=1, out=self.counts[i, firstRow:lastRow, 1:])
+        self.nbytes = self.sums.nbytes + self.counts.nbytes
+
+    #
+    # The sum and histogram of the cells in rows [firstRow, lastRow) and columns
+    # [firstCol, lastCol), read from the data set
+    #
+    def cellStatistics(self, firstRow, lastRow, firstCol, lastCol):
+        if firstRow >= lastRow or firstCol >= lastCol:
+            return (0.0, numpy.zeros(len(binStarts), dtype=numpy.int64))
+        values = self.dataset.getBlock(firstRow, lastRow, firstCol, lastCol)
+        return (midpoints[values].sum(), numpy.bincount(getBins(values).ravel(), minlength=len(binStarts)))
+
+    #
+    # The sum and histogram over rows [firstRow, lastRow) and columns [firstCol,
+    # lastCol), which must not cross the dateline: the whole column blocks from
+    # the tables, the rest from the cells
+    #
+    def rectangleStatistics(self, firstRow, lastRow, firstCol, lastCol):
+        firstBlock = -(-firstCol / self.blockColumns)
+        lastBlock = lastCol / self.blockColumns
+        if firstBlock >= lastBlock: return self.cellStatistics(firstRow, lastRow, firstCol, lastCol)
+        total = (self.sums[firstRow:lastRow, lastBlock] - self.sums[firstRow:lastRow, firstBlock]).sum()
+        histogram = (self.counts[:, firstRow:lastRow, lastBlock].astype(numpy.int64) -
+                     self.counts[:, firstRow:lastRow, firstBlock]).sum(axis=1)
+        for (start, stop) in [(firstCol, firstBlock * self.blockColumns), (lastBlock * self.blockColumns, lastCol)]:
+            (edgeTotal, edgeHistogram) = self.cellStatistics(firstRow, lastRow, start, stop)
+            (total, histogram) = (total + edgeTotal, histogram + edgeHistogram)
+        return (total, histogram)
+
+    #
+    # The aggregates over a block, clamped to the grid like DataSet.getBlock; if
+    # firstCol > lastCol the block crosses the dateline
+    #
+    def getAggregate(self, firstRow, lastRow, firstCol, lastCol):
+        firstRow = max(firstRow, 0)
+        lastRow = max(min(lastRow, self.numRows), firstRow)
+        firstCol = min(max(firstCol, 0), self.rowLength)
+        lastCol = min(max(lastCol, 0), self.rowLength)
+        if firstCol > lastCol:
+            rectangles = [(firstRow, lastRow, firstCol, self.rowLength), (firstRow, lastRow, 0, lastCol)]
+        else:
+            rectangles = [(firstRow, lastRow, firstCol, lastCol)]
+        statistics = [self.rectangleStatistics(*rectangle) for rectangle in rectangles]
+        total = sum([rectangleTotal for (rectangleTotal, rectangleHistogram) in statistics])
+        histogram = sum([rectangleHistogram for (rectangleTotal, rectangleHistogram) in statistics])
+        cells = int(histogram.sum())
+        return {'cells': cells, 'sum': float(total), 'mean': float(total) / cells if cells else 0.0,
+                'nonzero': cells - int(histogram[0]), 'histogram': [int(count) for count in histogram]}
@@ -0,0 +1,70 @@
+#
+# Compressed responses.  Most cells are 'A' (zero), so the data responses
+# compress extremely well.  chooseEncoding picks gzip or deflate from the
+# request's Accept-Encoding, and compressBody compresses a body with it.  The
+# PrecompressedCache keeps the compressed bodies of the common views (the whole
+# world and the continents, precompressedViews in config), so for those the
+# search, serialization and compression are done once per data set rather than
+# on every request.  Like the ResponseCache it is an LRU bounded by the bytes of
+# (compressed) body it holds
+#
+import zlib
+import math
+from responseCache import ResponseCache
+from config import compressMinBytes, compressionLevel, precompressedViews, precompressedCacheBytes
+
+encodings = ['gzip', 'deflate']
+
+#
+# The encoding to use for a request: the one of encodings the client prefers,
+# or None if it accepts neither
+#
+def chooseEncoding(request):
+    return request.accept_encodings.best_match(encodings)
+
+#
+# Compress body with encoding ('gzip' or 'deflate', which in HTTP is the zlib
+# format).  Returns (body, encoding): bodies too short to be worth compressing,
+# or with no encoding, come back as they are with encoding None
+#
+def compressBody(body, encoding):
+    if encoding is None or len(body) < compressMinBytes: return (body, None)
+    if encoding == 'deflate': return (zlib.compress(body, compressionLevel), encoding)
+    compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (compressor.compress(body) + compressor.flush(), encoding)
+
+#
+# Compress a stream of chunks with encoding, chunk by chunk, so a streamed
+# response is never held in memory whole.  With no encoding the chunks pass through
+#
+def compressChunks(chunks, encoding):
+    if encoding is None:
+        for chunk in chunks: yield chunk
+        return
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compressor = zlib.compressobj(compressionLevel, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed: yield compressed
+    yield compressor.flush()
+
+#
+# The (nwLat, seLat, nwLon, seLon) of a view in tenths of degrees, as the server
+# has them after convertDegreesToTenthsOfDegrees
+#
+def viewInTenths(view):
+    return tuple([int(math.floor(coordinate * 10)) for coordinate in view])
+
+#
+# A ResponseCache for the compressed bodies of the common views
+#
+class PrecompressedCache(ResponseCache):
+    def __init__(self, maxBytes = precompressedCacheBytes):
+        ResponseCache.__init__(self, maxBytes)
+        self.views = set([viewInTenths(view) for view in precompressedViews.values()])
+
+    #
+    # Is the query (with its coordinates in tenths of degrees) one of the common views?
+    #
+    def isCommonView(self, query):
+        return (query['nwLat'], query['seLat'], query['nwLon'], query['seLon']) in self.views
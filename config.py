@@ -17,4 +17,121 @@ port = 8888
 ssl_directive = {
 	'use_ssl': False,
 	'ssl_context': ('myFile.crt', 'myFile.key')
-}
\ No newline at end of file
+}
+#
+# Memory budget, in bytes of (packed) cell data, for the data sets the
+# DataManager keeps loaded.  When a load takes it over the budget, the least
+# recently used data sets are unloaded.  Data sets at the resolutions in
+# pinnedResolutions are never unloaded
+#
+memoryBudget = 4 * 1000 * 1000 * 1000
+pinnedResolutions = [1, 2, 4]
+#
+# The longest a request may wait (the wait=<ms> argument) for the resolution it
+# asked for to load before it is served the best loaded resolution instead
+#
+maxWaitMs = 5000
+#
+# Number of threads loading data sets in the background
+#
+loaderThreads = 4
+#
+# Prefetch the months either side of, and the next finer resolution of, each data
+# set users look at.  Prefetching stops when the loaded data sets reach
+# prefetchMemoryFraction of memoryBudget
+#
+prefetchEnabled = True
+prefetchMemoryFraction = 0.8
+#
+# Popularity of data sets, which orders the warm-up at startup: the half-life of
+# an access, and how often (in seconds) the scores are saved
+#
+popularityHalfLifeDays = 7
+popularitySaveInterval = 300
+#
+# Parameters of the Base64Encoder used to build the data sets (and to decode
+# symbols back to approximate values)
+#
+encoderMaxX = 60
+encoderMaxY = 60
+#
+# If the manifest has the res 10 data set for a month but not res 1, 2 or 4, those
+# are derived from res 10 when they are loaded.  derivedAggregation says how the
+# res 10 cells in a coarse cell are combined: 'max' or 'mean' (of decoded values)
+#
+derivedAggregation = 'max'
+#
+# Compression of responses.  Bodies shorter than compressMinBytes are sent as
+# they are; the others are compressed with gzip or deflate (whichever the client
+# prefers) at compressionLevel
+#
+compressMinBytes = 512
+compressionLevel = 6
+#
+# The views whose compressed responses are kept, so the popular data sets are
+# compressed once rather than on every request: (nwLat, seLat, nwLon, seLon) in
+# degrees, as the front end asks for them.  The cache holds at most
+# precompressedCacheBytes of compressed bodies, least recently used first out
+#
+precompressedViews = {
+	'world': (90, -90, -180, 180),
+	'northAmerica': (75, 10, -170, -50),
+	'southAmerica': (15, -60, -95, -30),
+	'europe': (72, 34, -25, 45),
+	'africa': (38, -36, -20, 55),
+	'asia': (78, -12, 25, 180),
+	'oceania': (0, -50, 110, 180)
+}
+precompressedCacheBytes = 256 * 1000 * 1000
+#
+# The cache of (uncompressed) data responses holds at most responseCacheBytes of
+# bodies.  Responses at the requested resolution may be reused by browsers and
+# proxies for responseMaxAge seconds, after which they revalidate with their ETag
+#
+responseCacheBytes = 256 * 1000 * 1000
+responseMaxAge = 24 * 3600
+#
+# Map tiles (/tiles/<year>/<month>/<z>/<x>/<y>.png): tileSize pixels square, zoom
+# levels 0 to maxTileZoom, with at most tileCacheBytes of rendered tiles cached
+#
+tileSize = 256
+maxTileZoom = 12
+tileCacheBytes = 128 * 1000 * 1000
+#
+# The most cells a /get_timeseries bounding box may cover
+#
+maxTimeSeriesCells = 2500
+#
+# The histogram bins for /get_aggregate, by the lowest symbol in each bin.  The
+# first bin must be symbol 0 (no pollution) alone.  Every bin costs a table of 2
+# bytes per aggregateBlockColumns cells for each data set aggregated over
+#
+aggregateHistogramBins = [0, 1, 8, 16, 32, 48]
+#
+# The columns between the prefix sums /get_aggregate keeps for each row (see
+# aggregates.py).  Fewer means bigger tables but fewer cells read per query
+#
+aggregateBlockColumns = 32
+#
+# The most queries a /batch request may hold
+#
+maxBatchQueries = 200
+#
+# How a search is cut down to the maxPoints a client asks for: 'max' takes the
+# max of each block of cells (so peaks still show), 'stride' takes every n-th cell
+#
+lodAggregation = 'max'
+#
+# In /get_data_delta responses, changed spans separated by at most deltaMergeGap
+# unchanged cells are joined
+#
+deltaMergeGap = 8
+#
+# Streamed responses (stream=1) read and send the data streamChunkCells cells
+# (rounded to whole rows) at a time
+#
+streamChunkCells = 256 * 1024
+#
+# The number of rasterized polygons (/get_data_polygon masks) kept
+#
+maxCachedMasks = 256
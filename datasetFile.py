@@ -0,0 +1,278 @@
+#
+# Binary on-disk format for a single (year, month, res) data set.  The file is a
+# small fixed header followed by the cells of the data set in row-major order
+# (the same order as the base64 strings: from the dateline east, from the south
+# pole north).  Cells are either one byte per cell (the base64 symbol) or packed,
+# four 6-bit cells in three bytes, which is the same bit layout base64 itself uses.
+# Files are opened with mmap, so opening a data set costs about as much as
+# opening the file, and the pages are shared (through the page cache) by every
+# process which has the data set open.
+#
+import mmap
+import math
+import struct
+import numpy
+from mapping import fullSetSize, base64, symbolValues, encodeSymbols
+
+#
+# The header: magic, format version, cell encoding, res, month, year, reserved,
+# number of cells.  Little-endian, 16 bytes
+#
+magic = 'PM25'
+formatVersion = 1
+headerFormat = '<4sBBBBHHI'
+headerSize = struct.calcsize(headerFormat)
+
+#
+# Cell encodings.  ENCODING_SYMBOL is one base64 symbol per byte, ENCODING_PACKED
+# is four 6-bit symbol values in three bytes
+#
+ENCODING_SYMBOL = 0
+ENCODING_PACKED = 1
+
+class DataSetFormatError(Exception):
+    pass
+
+#
+# Pack and unpack the header.  The header is returned as a dictionary
+#
+def makeHeader(year, month, res, numCells, encoding = ENCODING_PACKED):
+    return struct.pack(headerFormat, magic, formatVersion, encoding, res, month, year, 0, numCells)
+
+def readHeader(aString):
+    if len(aString) < headerSize:
+        raise DataSetFormatError('File too short for a header')
+    (fileMagic, version, encoding, res, month, year, reserved, numCells) = struct.unpack(headerFormat, aString[:headerSize])
+    if fileMagic != magic:
+        raise DataSetFormatError('Bad magic number %s' % repr(fileMagic))
+    if version != formatVersion:
+        raise DataSetFormatError('Unsupported format version %d' % version)
+    return {'encoding': encoding, 'res': res, 'month': month, 'year': year, 'numCells': numCells}
+
+#
+# is this a binary data set file (as opposed to a legacy file which is just the
+# base64 string)?
+#
+def isBinaryDataSetFile(fileName):
+    f = open(fileName, 'rb')
+    prefix = f.read(len(magic))
+    f.close()
+    return prefix == magic
+
+#
+# Convert a base64 string to an array of symbol values (encodeSymbols, in
+# mapping.py, goes the other way)
+#
+def decodeSymbols(aBase64String):
+    values = symbolValues[numpy.frombuffer(aBase64String, dtype=numpy.uint8)]
+    if len(values) > 0 and values.max() == 255:
+        raise DataSetFormatError('Data set contains a character which is not a base64 symbol')
+    return values
+
+#
+# Pack an array of symbol values four cells to three bytes, and unpack it again.
+# Both take and return numpy uint8 arrays, and work along the last axis, whose
+# length must be a multiple of 4 (packing) or 3 (unpacking), so a 2-D block of
+# rows packs and unpacks row by row
+#
+def packCells(values):
+    cells = numpy.asarray(values, dtype=numpy.uint8)
+    packed = numpy.empty(cells.shape[:-1] + (cells.shape[-1] / 4 * 3,), dtype=numpy.uint8)
+    packed[..., 0::3] = (cells[..., 0::4] << 2) | (cells[..., 1::4] >> 4)
+    packed[..., 1::3] = ((cells[..., 1::4] & 15) << 4) | (cells[..., 2::4] >> 2)
+    packed[..., 2::3] = ((cells[..., 2::4] & 3) << 6) | cells[..., 3::4]
+    return packed
+
+def unpackCells(packedBytes):
+    packed = numpy.asarray(packedBytes, dtype=numpy.uint8)
+    cells = numpy.empty(packed.shape[:-1] + (packed.shape[-1] / 3 * 4,), dtype=numpy.uint8)
+    cells[..., 0::4] = packed[..., 0::3] >> 2
+    cells[..., 1::4] = ((packed[..., 0::3] & 3) << 4) | (packed[..., 1::3] >> 4)
+    cells[..., 2::4] = ((packed[..., 1::3] & 15) << 2) | (packed[..., 2::3] >> 6)
+    cells[..., 3::4] = packed[..., 2::3] & 63
+    return cells
+
+#
+# Pack a block of symbol values (any shape) in row-major order, padding the end
+# with zeros to a whole number of 4-cell groups.  Returns the packed bytes as a string
+#
+def packBlock(values):
+    cells = numpy.asarray(values, dtype=numpy.uint8).ravel()
+    padding = -len(cells) % 4
+    if padding: cells = numpy.concatenate([cells, numpy.zeros(padding, dtype=numpy.uint8)])
+    return packCells(cells).tostring()
+
+#
+# Write a data set, given as a base64 string, to fileName in the binary format.
+# By default the cells are packed
+#
+def writeDataSet(fileName, year, month, res, base64String, encoding = ENCODING_PACKED):
+    if len(base64String) != fullSetSize(res):
+        raise DataSetFormatError('Data set for year = %d, month = %d, res = %d has %d entries, expected %d' %
+                                 (year, month, res, len(base64String), fullSetSize(res)))
+    if encoding == ENCODING_PACKED:
+        cells = packCells(decodeSymbols(base64String)).tostring()
+    else:
+        cells = base64String
+    f = open(fileName, 'wb')
+    f.write(makeHeader(year, month, res, len(base64String), encoding))
+    f.write(cells)
+    f.close()
+
+#
+# What the data set classes share.  A data set is a grid of 180 * res rows by
+# 360 * res columns; subclasses provide getGrid, the grid of stored bytes as a 2-D
+# numpy array (a view of the storage, nothing is copied), and getRectangle, the
+# symbol values of a block of it
+#
+class DataSet:
+    def initGrid(self, numCells):
+        self.numCells = numCells
+        self.res = int(round(math.sqrt(numCells / float(fullSetSize(1)))))
+        self.numRows = 180 * self.res
+        self.rowLength = 360 * self.res
+
+    def __len__(self):
+        return self.numCells
+
+    #
+    # The symbol values for rows [firstRow, lastRow) and columns [firstCol, lastCol)
+    # as a 2-D numpy array.  If firstCol > lastCol the block crosses the dateline,
+    # and is the block from firstCol to the end of the row followed by the block
+    # from the start of the row to lastCol.  Rows and columns are clamped to the grid
+    #
+    def getBlock(self, firstRow, lastRow, firstCol, lastCol):
+        firstRow = max(firstRow, 0)
+        lastRow = max(min(lastRow, self.numRows), firstRow)
+        firstCol = min(max(firstCol, 0), self.rowLength)
+        lastCol = min(max(lastCol, 0), self.rowLength)
+        if firstCol > lastCol:
+            east = self.getRectangle(firstRow, lastRow, firstCol, self.rowLength)
+            west = self.getRectangle(firstRow, lastRow, 0, lastCol)
+            return numpy.hstack([east, west])
+        return self.getRectangle(firstRow, lastRow, firstCol, lastCol)
+
+    def close(self):
+        if isinstance(self.storage, mmap.mmap): self.storage.close()
+
+#
+# A data set with one base64 symbol per byte.  This behaves like the base64
+# string for the data set: len() is the number of cells and slicing returns the
+# base64 string for the slice.  storage is anything which supports the buffer
+# interface (a str, or an mmap of the file), and the cells start at offset.
+# Nothing is copied until a slice is taken
+#
+class SymbolDataSet(DataSet):
+    def __init__(self, storage, offset, numCells):
+        self.storage = storage
+        self.offset = offset
+        self.initGrid(numCells)
+        self.nbytes = numCells
+
+    def __getitem__(self, aSlice):
+        if isinstance(aSlice, slice):
+            (start, stop, step) = aSlice.indices(self.numCells)
+            return self.storage[self.offset + start:self.offset + stop:step]
+        if aSlice < 0: aSlice += self.numCells
+        if aSlice < 0 or aSlice >= self.numCells:
+            raise IndexError('data set index out of range')
+        return self.storage[self.offset + aSlice]
+
+    #
+    # The symbol values (0-63) for cells start to stop, as a numpy array
+    #
+    def getValues(self, start, stop):
+        return symbolValues[numpy.frombuffer(self.storage, dtype=numpy.uint8, count=stop - start, offset=self.offset + start)]
+
+    def getGrid(self):
+        cells = numpy.frombuffer(self.storage, dtype=numpy.uint8, count=self.numCells, offset=self.offset)
+        return cells.reshape(self.numRows, self.rowLength)
+
+    def getRectangle(self, firstRow, lastRow, firstCol, lastCol):
+        return symbolValues[self.getGrid()[firstRow:lastRow, firstCol:lastCol]]
+
+#
+# A data set packed four cells to three bytes.  Like SymbolDataSet, slicing
+# returns the base64 string for the slice; only the cells in the slice are
+# unpacked and re-encoded.  Every row has 360 * res cells, a multiple of 4, so
+# rows always start and end on a byte boundary
+#
+class PackedDataSet(DataSet):
+    def __init__(self, storage, offset, numCells):
+        self.storage = storage
+        self.offset = offset
+        self.initGrid(numCells)
+        self.nbytes = numCells * 3 / 4
+
+    def __getitem__(self, aSlice):
+        if isinstance(aSlice, slice):
+            (start, stop, step) = aSlice.indices(self.numCells)
+            if stop <= start: return ''
+            result = encodeSymbols(self.getValues(start, stop))
+            return result if step == 1 else result[::step]
+        if aSlice < 0: aSlice += self.numCells
+        if aSlice < 0 or aSlice >= self.numCells:
+            raise IndexError('data set index out of range')
+        return base64[self.getValues(aSlice, aSlice + 1)[0]]
+
+    #
+    # The symbol values (0-63) for cells start to stop, as a numpy array.  This
+    # unpacks the 4-cell groups covering the range and trims the ends
+    #
+    def getValues(self, start, stop):
+        firstGroup = start / 4
+        lastGroup = (stop + 3) / 4
+        if lastGroup <= firstGroup: return numpy.zeros(0, dtype=numpy.uint8)
+        packed = numpy.frombuffer(self.storage, dtype=numpy.uint8, count=3 * (lastGroup - firstGroup), offset=self.offset + 3 * firstGroup)
+        cells = unpackCells(packed)
+        return cells[start - 4 * firstGroup:stop - 4 * firstGroup]
+
+    #
+    # The grid of packed bytes: each row is 270 * res bytes
+    #
+    def getGrid(self):
+        packed = numpy.frombuffer(self.storage, dtype=numpy.uint8, count=self.nbytes, offset=self.offset)
+        return packed.reshape(self.numRows, self.rowLength / 4 * 3)
+
+    #
+    # Take the strided slice of the packed grid covering the 4-cell groups in
+    # the block, unpack it and trim the ends
+    #
+    def getRectangle(self, firstRow, lastRow, firstCol, lastCol):
+        firstGroup = firstCol / 4
+        lastGroup = (lastCol + 3) / 4
+        packed = self.getGrid()[firstRow:lastRow, 3 * firstGroup:3 * lastGroup]
+        cells = unpackCells(packed)
+        return cells[:, firstCol - 4 * firstGroup:lastCol - 4 * firstGroup]
+
+#
+# Open a data set file.  Binary files are memory-mapped; legacy files (just the
+# base64 string) are read and packed in memory
+#
+def openDataSet(fileName):
+    if not isBinaryDataSetFile(fileName):
+        f = open(fileName)
+        base64String = f.read().strip()
+        f.close()
+        if len(base64String) % 4 != 0:
+            return SymbolDataSet(base64String, 0, len(base64String))
+        return PackedDataSet(packCells(decodeSymbols(base64String)).tostring(), 0, len(base64String))
+    f = open(fileName, 'rb')
+    try:
+        storage = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    header = readHeader(storage[:headerSize])
+    numCells = header['numCells']
+    if header['encoding'] == ENCODING_PACKED:
+        dataset = PackedDataSet(storage, headerSize, numCells)
+    elif header['encoding'] == ENCODING_SYMBOL:
+        dataset = SymbolDataSet(storage, headerSize, numCells)
+    else:
+        storage.close()
+        raise DataSetFormatError('File %s has unknown cell encoding %d' % (fileName, header['encoding']))
+    if len(storage) < headerSize + dataset.nbytes:
+        storage.close()
+        raise DataSetFormatError('File %s is truncated: expected %d cells' % (fileName, numCells))
+    dataset.header = header
+    return dataset
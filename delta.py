@@ -0,0 +1,32 @@
+#
+# Deltas between two searches of the same box at the same resolution, for
+# clients animating through months: the client has the base month, and gets
+# only the cells which differ in the new one.  The changes are spans over the
+# row-major index space of the search (the order of getDataAsSequences, row
+# after row from the south-west corner): each span is its first index and the
+# new symbols from there on.  Two spans separated by at most mergeGap unchanged
+# cells are sent as one, since a span costs more than a few cells
+#
+import numpy
+from mapping import encodeSymbols
+from config import deltaMergeGap
+
+#
+# The spans of cells which differ between two arrays of the same shape, as
+# arrays of the first and one-past-the-last row-major index of each span
+#
+def findChangedSpans(baseValues, values, mergeGap = deltaMergeGap):
+    changed = numpy.concatenate([[False], (numpy.ravel(baseValues) != numpy.ravel(values)), [False]])
+    edges = numpy.diff(changed.astype(numpy.int8))
+    (starts, stops) = (numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1))
+    if len(starts) > 1:
+        keep = numpy.concatenate([[True], starts[1:] - stops[:-1] > mergeGap])
+        (starts, stops) = (starts[keep], numpy.append(stops[numpy.flatnonzero(keep)[1:] - 1], stops[-1]))
+    return (starts, stops)
+
+#
+# The spans as a list of [first index, base64 symbols of the new values]
+#
+def formatSpans(values, starts, stops):
+    cells = numpy.ravel(values)
+    return [[start, encodeSymbols(cells[start:stop])] for (start, stop) in zip(starts.tolist(), stops.tolist())]
@@ -0,0 +1,75 @@
+#
+# Derive the coarser resolutions (res 1, 2 and 4) of a month from its res 10
+# data set, so the archive only has to store res 10.  A res 10 cell is the tenth
+# of a degree it sits in, and it falls in the coarse cell which the coarse
+# resolution's OffsetComputer gives for that tenth of a degree -- the same
+# mapping the builder uses to place points.  Each coarse cell is the max (or the
+# mean of the decoded values) of the res 10 cells which fall in it.  The
+# aggregation is done one axis at a time with numpy reduceat: the cell mapping
+# is non-decreasing, so the fine cells for each coarse cell are contiguous
+#
+import numpy
+from mapping import offsetComputers, fullSetSize, Base64Encoder
+from datasetFile import PackedDataSet, packCells
+from config import derivedAggregation, encoderMaxX, encoderMaxY
+
+encoder = Base64Encoder(encoderMaxX, encoderMaxY)
+indexMaps = {}
+
+#
+# For each res 10 row (numDegrees = 180) or column (numDegrees = 360), the index
+# of the row or column at res it falls in.  Offsets which fall before the first
+# point of the first degree, or past the last point of the last, are clamped
+#
+def getCoarseIndexMap(res, numDegrees):
+    if (res, numDegrees) in indexMaps: return indexMaps[(res, numDegrees)]
+    offsetComputer = offsetComputers[res]
+    lookup = offsetComputer.rowIndices if numDegrees == 180 else offsetComputer.colIndices
+    coarse = lookup[:numDegrees * 10]
+    indexMaps[(res, numDegrees)] = numpy.clip(coarse, 0, numDegrees * res - 1)
+    return indexMaps[(res, numDegrees)]
+
+#
+# Reduce values along axis with ufunc (numpy.maximum, numpy.add), combining the
+# entries which indexMap sends to the same coarse index.  Coarse indices which
+# nothing maps to are 0
+#
+def aggregateAxis(values, indexMap, numCoarse, axis, ufunc):
+    starts = numpy.flatnonzero(numpy.r_[True, indexMap[1:] != indexMap[:-1]])
+    reduced = ufunc.reduceat(values, starts, axis=axis)
+    shape = list(values.shape)
+    shape[axis] = numCoarse
+    result = numpy.zeros(shape, dtype=reduced.dtype)
+    index = [slice(None), slice(None)]
+    index[axis] = indexMap[starts]
+    result[tuple(index)] = reduced
+    return result
+
+#
+# Derive the symbol values at res from the res 10 symbol values, as a 2-D
+# (rows x columns) array.  aggregation is 'max' or 'mean'
+#
+def deriveValues(fineValues, res, aggregation = derivedAggregation):
+    grid = numpy.asarray(fineValues).reshape(1800, 3600)
+    rowMap = getCoarseIndexMap(res, 180)
+    colMap = getCoarseIndexMap(res, 360)
+    if aggregation == 'max':
+        byColumn = aggregateAxis(grid, colMap, 360 * res, 1, numpy.maximum)
+        return aggregateAxis(byColumn, rowMap, 180 * res, 0, numpy.maximum)
+    if aggregation != 'mean':
+        raise ValueError('Unknown aggregation %s, expected max or mean' % aggregation)
+    midpoints = encoder.getMidpoints().astype(numpy.float32)
+    byColumn = aggregateAxis(midpoints[grid], colMap, 360 * res, 1, numpy.add)
+    sums = aggregateAxis(byColumn, rowMap, 180 * res, 0, numpy.add)
+    counts = numpy.outer(numpy.bincount(rowMap, minlength=180 * res), numpy.bincount(colMap, minlength=360 * res))
+    return encoder.encodeArray(sums / numpy.maximum(counts, 1))
+
+#
+# Derive the data set at res from a res 10 data set.  The result is a
+# PackedDataSet held in memory
+#
+def deriveDataSet(fineDataSet, res, aggregation = derivedAggregation):
+    if len(fineDataSet) != fullSetSize(10):
+        raise ValueError('Can only derive from a res 10 data set, got %d cells' % len(fineDataSet))
+    values = deriveValues(fineDataSet.getValues(0, len(fineDataSet)), res, aggregation)
+    return PackedDataSet(packCells(values.reshape(-1)).tostring(), 0, fullSetSize(res))
@@ -1,58 +1,373 @@
-from config import dataDirectory
+from config import dataDirectory, memoryBudget, pinnedResolutions, loaderThreads, derivedAggregation
+import os
 import json
+import time
+import hashlib
+from collections import OrderedDict
 from mapping import fullSetSize
-from Queue import Queue
+from datasetFile import openDataSet, DataSetFormatError
+from timeSeries import openTimeSeriesIndex, timeSeriesFileName, versionDigest
+from aggregates import AggregateTables
+from popularity import PopularityTracker
+from deriveResolutions import deriveDataSet
+from Queue import PriorityQueue
+from threading import Thread, Event, Lock, RLock
+
+#
+# Load priorities: lower numbers are loaded first.  Loads a user is waiting for
+# go ahead of the startup warm-up, which goes ahead of speculative (prefetch) loads
 #
-# An Asynchronous loader...
+PRIORITY_USER = 0
+PRIORITY_WARMUP = 1
+PRIORITY_PREFETCH = 2
+priorityNames = {PRIORITY_USER: 'User', PRIORITY_WARMUP: 'Warmup', PRIORITY_PREFETCH: 'Prefetch'}
+
+class LoadCancelled(Exception):
+    pass
+
 #
-from threading import Thread
+# The result of loading a data set, shared by everyone who asks for the data set
+# while the load is in flight.  wait(timeout) returns True once the load is done
+# (timeout in seconds, None to wait forever); result() waits and returns the data
+# set, or raises the exception the load raised
+#
+class LoadFuture:
+    def __init__(self):
+        self.event = Event()
+        self.dataset = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
 
+    def wait(self, timeout = None):
+        return self.event.wait(timeout)
+
+    def result(self):
+        self.event.wait()
+        if self.error is not None: raise self.error
+        return self.dataset
+
+    def setResult(self, dataset, error = None):
+        self.dataset = dataset
+        self.error = error
+        self.event.set()
+
+#
+# An Asynchronous loader: one of the threads of a LoaderPool
+#
 class AsynchLoader(Thread):
-    def __init__(self, dataManager):
+    def __init__(self, loaderPool):
         Thread.__init__(self)
-        self.dataManager = dataManager
+        self.daemon = True
+        self.loaderPool = loaderPool
 
     def run(self):
         while True:
-            year, month, res = self.dataManager.loadQueue.get()
-            self.dataManager.loadDataSet(year, month, res)
-            self.dataManager.lockDict[(year, month, res)] = False
-            self.dataManager.loadQueue.task_done()
+            (priority, sequence, (year, month, res), queuedAt) = self.loaderPool.next()
+            start = time.time()
+            failed = False
+            try:
+                self.loaderPool.dataManager.completeLoad(year, month, res)
+            except Exception as e:
+                print 'Asynchronous load failed for year = %d, month = %d, res = %d: %s' % (year, month, res, e)
+                failed = True
+            self.loaderPool.recordLoad(priority, start - queuedAt, time.time() - start, failed)
+
+#
+# A pool of asynchronous loaders draining a priority queue of (year, month, res)
+# keys.  Each key is queued at most once: submitting a key which is already queued
+# only raises its priority, and a queued key can be cancelled.  Stale queue
+# entries (cancelled, or superseded by a higher priority) are skipped by next().
+# self.queued maps each queued key to its live queue entry
+#
+class LoaderPool:
+    def __init__(self, dataManager, numThreads):
+        self.dataManager = dataManager
+        self.queue = PriorityQueue()
+        self.lock = Lock()
+        self.queued = {}
+        self.sequence = 0
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'reprioritized': 0, 'cancelled': 0,
+                      'loaded': 0, 'failed': 0, 'totalLoadTime': 0.0, 'maxLoadTime': 0.0,
+                      'totalQueueWait': 0.0, 'loadedByPriority': dict([(priority, 0) for priority in priorityNames])}
+        self.threads = [AsynchLoader(self) for i in range(numThreads)]
+
+    def start(self):
+        for thread in self.threads: thread.start()
+
+    def enqueue(self, key, priority):
+        self.sequence += 1
+        entry = (priority, self.sequence, key, time.time())
+        self.queued[key] = entry
+        self.queue.put(entry)
+
+    #
+    # Queue a load.  Only the owner of the load (see DataManager.getLoadFuture)
+    # should submit it
+    #
+    def submit(self, key, priority):
+        with self.lock:
+            self.stats['submitted'] += 1
+            if key in self.queued:
+                self.stats['deduplicated'] += 1
+                if priority < self.queued[key][0]: self.enqueue(key, priority)
+                return
+            self.enqueue(key, priority)
+
+    #
+    # Someone else wants a load which is already in flight.  If it is still queued
+    # at a lower priority, raise it
+    #
+    def promote(self, key, priority):
+        with self.lock:
+            self.stats['deduplicated'] += 1
+            if key in self.queued and priority < self.queued[key][0]:
+                self.stats['reprioritized'] += 1
+                self.enqueue(key, priority)
+
+    #
+    # Cancel a queued load.  Returns True if the load was queued (and so will not
+    # happen), False if it wasn't queued or has already started.  If priority is
+    # given, only a load queued at that priority is cancelled
+    #
+    def cancel(self, key, priority = None):
+        with self.lock:
+            if not key in self.queued: return False
+            if priority is not None and self.queued[key][0] != priority: return False
+            del self.queued[key]
+            self.stats['cancelled'] += 1
+            return True
+
+    def isQueued(self, key):
+        with self.lock:
+            return key in self.queued
+
+    #
+    # The next live entry on the queue, blocking until there is one
+    #
+    def next(self):
+        while True:
+            entry = self.queue.get()
+            with self.lock:
+                key = entry[2]
+                if self.queued.get(key) == entry:
+                    del self.queued[key]
+                    return entry
+
+    def recordLoad(self, priority, queueWait, loadTime, failed):
+        with self.lock:
+            if failed:
+                self.stats['failed'] += 1
+                return
+            self.stats['loaded'] += 1
+            self.stats['loadedByPriority'][priority] += 1
+            self.stats['totalLoadTime'] += loadTime
+            self.stats['totalQueueWait'] += queueWait
+            self.stats['maxLoadTime'] = max(self.stats['maxLoadTime'], loadTime)
+
+    #
+    # Queue depth and load time statistics, times in milliseconds
+    #
+    def getStats(self):
+        with self.lock:
+            depthByPriority = dict([(priority, 0) for priority in priorityNames])
+            for entry in self.queued.values(): depthByPriority[entry[0]] += 1
+            loaded = max(self.stats['loaded'], 1)
+            result = {'threads': len(self.threads), 'queueDepth': len(self.queued),
+                      'submitted': self.stats['submitted'], 'deduplicated': self.stats['deduplicated'],
+                      'reprioritized': self.stats['reprioritized'], 'cancelled': self.stats['cancelled'],
+                      'loaded': self.stats['loaded'], 'failed': self.stats['failed'],
+                      'meanLoadTime(ms)': self.stats['totalLoadTime'] * 1000 / loaded,
+                      'maxLoadTime(ms)': self.stats['maxLoadTime'] * 1000,
+                      'meanQueueWait(ms)': self.stats['totalQueueWait'] * 1000 / loaded}
+            for (priority, name) in priorityNames.items():
+                result['queueDepth' + name] = depthByPriority[priority]
+                result['loaded' + name] = self.stats['loadedByPriority'][priority]
+            return result
+
+#
+# Data set versions (see DataManager.getVersion).  A data set the manifest gives
+# no version has the size and modification time of its file; a derived data
+# set's is its res 10 data set's, the resolution and the aggregation.  The
+# builder uses these too, to record the versions a time series index is built from
+#
+def getFileVersion(fileName):
+    info = os.stat(fileName)
+    return '%d-%d' % (info.st_size, int(info.st_mtime))
+
+def getDerivedVersion(fineVersion, res):
+    return '%s/%d/%s' % (fineVersion, res, derivedAggregation)
+
+#
+# manifest.json is {'formatVersion': manifestFormatVersion, 'generation': n,
+# 'digest': d, 'dataSets': [records]}.  The builder counts up generation each time
+# it publishes a manifest, and digest is a hash of the records, so the manifest's
+# version (see getManifestVersion) changes whenever any record does.  A manifest
+# from before it had a version is just the list of records, and is read as format
+# 1, generation 0
+#
+manifestFormatVersion = 2
+
+def getManifestDigest(records):
+    return hashlib.sha1(json.dumps(records, sort_keys=True)).hexdigest()[:16]
+
+#
+# Read a manifest file: returns a pair (header, records), header holding
+# formatVersion, generation and digest.  Raises DataSetFormatError for a format
+# this code doesn't know
+#
+def readManifestFile(fileName):
+    manifestFile = open(fileName)
+    manifest = json.loads(manifestFile.read())
+    manifestFile.close()
+    if isinstance(manifest, list):
+        return ({'formatVersion': 1, 'generation': 0, 'digest': getManifestDigest(manifest)}, manifest)
+    if manifest.get('formatVersion') != manifestFormatVersion:
+        raise DataSetFormatError('Unknown manifest format %s' % manifest.get('formatVersion'))
+    header = dict([(name, manifest[name]) for name in ['formatVersion', 'generation', 'digest']])
+    return (header, manifest['dataSets'])
+
+def getManifestVersion(header):
+    return '%d.%d.%s' % (header['formatVersion'], header['generation'], header['digest'])
 
 #
 # The data manager for the visualizer.  This loads data sets on demand and unloads them
-# to keep memory usage in checkFunction
+# to keep memory usage in check.  Loaded data sets are kept in least-recently-used order
+# in self.lru; when the loaded bytes exceed memoryBudget the oldest unpinned data sets
+# are unloaded.  An unloaded data set is reloaded the next time it is asked for.
+# Loads are single-flight: self.loads holds a LoadFuture for every data set being
+# loaded, and anyone else who wants that data set waits on the future rather than
+# loading it again.  self.lock guards self.data, self.lru, self.loadedBytes and self.loads.
+# Nothing is loaded synchronously at startup: the constructor queues the warm-up (every
+# data set below res 10, most popular months first) on the loader pool and returns.
+# When the manifest has res 10 for a month but not a coarser resolution, the coarser
+# resolution is loadable anyway: it is derived from res 10 when it is loaded.  The keys
+# of those data sets are in self.derived
 #
 class DataManager:
     def __init__(self):
         self.data = {}
-        manifestFile = open(dataDirectory + '/manifest.json')
-        self.rawManifest = json.loads(manifestFile.read())
+        self.lock = RLock()
+        self.loads = {}
+        self.lru = OrderedDict()
+        self.loadedBytes = 0
+        self.memoryBudget = memoryBudget
+        self.pinned = set()
+        self.accessListeners = []
+        self.popularity = PopularityTracker(dataDirectory + '/popularity.json')
+        self.addAccessListener(self.popularity)
+        self.warmUpLoads = {}
+        self.derived = set()
+        self.versions = {}
+        self.timeSeries = {}
+        self.aggregateTables = {}
+        (self.manifestHeader, records) = readManifestFile(dataDirectory + '/manifest.json')
         self.manifest = {}
-        self.lockDict = {}
-        self.loadQueue = Queue()
-        self.asynchronousLoader = AsynchLoader(self)
-        for record in self.rawManifest:
+        self.loaderPool = LoaderPool(self, loaderThreads)
+        for record in records:
             key = (record['year'], record['month'], record['res'])
             self.manifest[key] = dataDirectory + '/' + record['file']
-            if record['res'] != 10:
-                self.loadDataSet(record['year'], record['month'], record['res'])
-            self.lockDict[key] = False
-        self.asynchronousLoader.start()
+            if 'version' in record: self.versions[key] = str(record['version'])
+        for (year, month, res) in self.manifest.keys():
+            if res != 10: continue
+            for coarseRes in [1, 2, 4]:
+                if (year, month, coarseRes) in self.manifest: continue
+                self.manifest[(year, month, coarseRes)] = self.manifest[(year, month, 10)]
+                self.derived.add((year, month, coarseRes))
+        self.loaderPool.start()
+        self.startWarmUp()
+
+    #
+    # Queue the loads of every data set below res 10, in parallel on the loader pool.
+    # The months users have looked at most recently go first, and within a month the
+    # lowest resolutions go first
+    #
+    def startWarmUp(self):
+        keys = [key for key in self.manifest.keys() if key[2] != 10]
+        monthScores = dict([((year, month), self.popularity.getMonthScore(year, month)) for (year, month, res) in keys])
+        keys.sort(key = lambda (year, month, res): (-monthScores[(year, month)], res, -year, -month))
+        for (year, month, res) in keys:
+            self.warmUpLoads[(year, month, res)] = self.asynchLoad(year, month, res, PRIORITY_WARMUP)
+
+    #
+    # Progress of the warm-up.  finished is True when every warm-up load has
+    # finished, and degraded when some of them have failed.  ready is True when
+    # every warm-up load has finished and none has failed: a server missing some
+    # of its low resolution data sets isn't ready
+    #
+    def getWarmUpStatus(self):
+        futures = self.warmUpLoads.values()
+        finished = [future for future in futures if future.done()]
+        failed = [future for future in finished if future.error is not None]
+        return {'ready': len(finished) == len(futures) and not failed, 'finished': len(finished) == len(futures),
+                'degraded': len(failed) > 0, 'total': len(futures),
+                'loaded': len(finished) - len(failed), 'failed': len(failed),
+                'bytesLoaded': self.getSize()}
+
+    def isReady(self):
+        return self.getWarmUpStatus()['ready']
 
     def hasDataSet(self, year, month, res):
-        return year in self.data and month in self.data[year] and res in self.data[year][month]
+        with self.lock:
+            return year in self.data and month in self.data[year] and res in self.data[year][month]
 
     def bestResolution(self, year, month):
-        if (not year in self.data) or (not month in self.data[year]):
-            return None
-        resolutions = self.data[year][month].keys()
-        resolutions.sort()
-        return resolutions[-1]
+        with self.lock:
+            if (not year in self.data) or (not month in self.data[year]):
+                return None
+            resolutions = self.data[year][month].keys()
+            resolutions.sort()
+            return resolutions[-1]
+
+    #
+    # The version of the manifest the server is running with (see readManifestFile)
+    #
+    def getManifestVersion(self):
+        return getManifestVersion(self.manifestHeader)
 
     def checkLoadable(self, year, month, res):
         return (year, month, res) in self.manifest
 
+    #
+    # The version of a data set, which changes whenever its contents can: the
+    # version the manifest gives it if there is one, otherwise the size and
+    # modification time of its file.  A derived data set's version is that of its
+    # res 10 data set and the aggregation.  None if the data set isn't loadable
+    #
+    def getVersion(self, year, month, res):
+        key = (year, month, res)
+        if not key in self.manifest: return None
+        if key in self.derived:
+            return getDerivedVersion(self.getVersion(year, month, 10), res)
+        with self.lock:
+            if not key in self.versions:
+                try:
+                    self.versions[key] = getFileVersion(self.manifest[key])
+                except OSError:
+                    return None
+            return self.versions[key]
+
+    #
+    # The time-major index for res (see timeSeries.py), or None if there isn't one
+    # or it doesn't cover exactly the months the manifest has at res, at the
+    # versions of their data sets the manifest has
+    #
+    def getTimeSeriesIndex(self, res):
+        with self.lock:
+            if res in self.timeSeries: return self.timeSeries[res]
+            months = sorted([(year, month) for (year, month, aRes) in self.manifest.keys() if aRes == res])
+            versions = [versionDigest(self.getVersion(year, month, res)) for (year, month) in months]
+            try:
+                index = openTimeSeriesIndex(timeSeriesFileName(dataDirectory, res))
+            except (IOError, DataSetFormatError):
+                index = None
+            if index is not None and (index.months != months or index.versions != versions):
+                print 'Time series index for res %d is out of date, not using it' % res
+                index.close()
+                index = None
+            self.timeSeries[res] = index
+            return index
 
     #
     # Utilities to query the data
@@ -65,12 +380,65 @@ class DataManager:
         return [res for (aYear, aMonth, res) in self.manifest.keys() if aYear == year and aMonth == month]
 
     #
-    # load a data set asynchronously
+    # Get the LoadFuture for a data set.  Returns a pair (future, isOwner): if the
+    # data set is loaded the future is already done; if a load is in flight it is
+    # that load's future; otherwise a new future is registered and isOwner is True,
+    # and the caller must call completeLoad to do the load
     #
-    def asynchLoad(self, year, month, res):
-        if self.lockDict[(year, month, res)]: return
-        self.lockDict[(year, month, res)] = True
-        self.loadQueue.put((year, month, res))
+    def getLoadFuture(self, year, month, res):
+        key = (year, month, res)
+        with self.lock:
+            if self.hasDataSet(year, month, res):
+                future = LoadFuture()
+                future.setResult(self.data[year][month][res])
+                return (future, False)
+            if key in self.loads:
+                return (self.loads[key], False)
+            future = LoadFuture()
+            self.loads[key] = future
+            return (future, True)
+
+    #
+    # load a data set asynchronously, at priority PRIORITY_USER (the default) or
+    # PRIORITY_PREFETCH.  Returns the LoadFuture for the load
+    #
+    def asynchLoad(self, year, month, res, priority = PRIORITY_USER):
+        (future, isOwner) = self.getLoadFuture(year, month, res)
+        if isOwner:
+            self.loaderPool.submit((year, month, res), priority)
+        elif not future.done():
+            self.loaderPool.promote((year, month, res), priority)
+        return future
+
+    #
+    # Cancel a queued asynchronous load.  Anyone waiting on it gets LoadCancelled.
+    # Returns True if the load was cancelled, False if it had already started.  If
+    # priority is given, the load is only cancelled if it is queued at that priority
+    #
+    def cancelLoad(self, year, month, res, priority = None):
+        key = (year, month, res)
+        if not self.loaderPool.cancel(key, priority): return False
+        with self.lock:
+            future = self.loads.pop(key, None)
+        if future is not None:
+            future.setResult(None, LoadCancelled('Load of year = %d, month = %d, res = %d cancelled' % key))
+        return True
+
+    def getLoaderStats(self):
+        return self.loaderPool.getStats()
+
+    #
+    # The search functions record every (year, month, res) asked for, before they
+    # fetch it, and we pass the access on to the listeners (e.g., a Prefetcher)
+    # along with whether the data set was loaded at the time
+    #
+    def addAccessListener(self, listener):
+        self.accessListeners.append(listener)
+
+    def recordAccess(self, year, month, res):
+        wasLoaded = self.hasDataSet(year, month, res)
+        for listener in self.accessListeners:
+            listener.recordAccess(year, month, res, wasLoaded)
 
 
     #
@@ -100,7 +468,8 @@ class DataManager:
     # Get the loaded (year, month, res) tuples
     #
     def getAllLoadedKeys(self):
-        return [(year, month, res) for year in self.data for month in self.data[year] for res in self.data[year][month]]
+        with self.lock:
+            return [(year, month, res) for year in self.data for month in self.data[year] for res in self.data[year][month]]
 
     #
     # Get the loadable (year, month, res) tuples
@@ -150,20 +519,148 @@ class DataManager:
 
 
 
+    #
+    # Load a data set synchronously, sharing the load with anyone else loading it.
+    # If the load is queued we raise it to PRIORITY_USER, since we are waiting for
+    # it, and if it is cancelled we try again.  Returns the data set
+    #
     def loadDataSet(self, year, month, res):
         if not (year, month, res) in self.manifest: return
-        f = open(self.manifest[(year, month, res)])
-        dataset = f.read()
-        f.close()
-        if not year in self.data: self.data[year] = {}
-        if not month in self.data[year]: self.data[year][month] = {}
-        self.data[year][month][res] = dataset
+        while True:
+            (future, isOwner) = self.getLoadFuture(year, month, res)
+            if isOwner:
+                self.completeLoad(year, month, res)
+            elif not future.done():
+                self.loaderPool.promote((year, month, res), PRIORITY_USER)
+            try:
+                return future.result()
+            except LoadCancelled:
+                continue
+
+    #
+    # Do the load registered by getLoadFuture, and resolve its future.  The file is
+    # opened without holding the lock
+    #
+    def completeLoad(self, year, month, res):
+        key = (year, month, res)
+        with self.lock:
+            future = self.loads.get(key)
+        if future is None: return
+        try:
+            if key in self.derived:
+                dataset = self.deriveDataSet(year, month, res)
+            else:
+                dataset = openDataSet(self.manifest[key])
+        except Exception as e:
+            with self.lock:
+                del self.loads[key]
+            future.setResult(None, e)
+            raise
+        with self.lock:
+            if not year in self.data: self.data[year] = {}
+            if not month in self.data[year]: self.data[year][month] = {}
+            self.data[year][month][res] = dataset
+            self.loadedBytes += dataset.nbytes
+            self.touch(year, month, res)
+            self.evict()
+            del self.loads[key]
+        future.setResult(dataset)
+
+    #
+    # Derive a coarse data set from res 10.  If res 10 is loaded we use it, otherwise
+    # we map its file just for the derivation, without loading it
+    #
+    def deriveDataSet(self, year, month, res):
+        with self.lock:
+            if self.hasDataSet(year, month, 10):
+                fineDataSet = self.data[year][month][10]
+            else:
+                fineDataSet = None
+        if fineDataSet is None:
+            fineDataSet = openDataSet(self.manifest[(year, month, 10)])
+        return deriveDataSet(fineDataSet, res)
 
     def getData(self, year, month, res):
-        if self.hasDataSet(year, month, res): return self.data[year][month][res]
+        with self.lock:
+            if self.hasDataSet(year, month, res):
+                self.touch(year, month, res)
+                return self.data[year][month][res]
         if (year, month, res) in self.manifest:
-            self.loadDataSet(year, month, res)
-            return self.data[year][month][res]
+            return self.loadDataSet(year, month, res)
+
+    #
+    # The AggregateTables for dataset, the data set loaded for (year, month, res).
+    # They are built the first time they are asked for, and kept (and counted in
+    # the loaded bytes) for as long as the data set is loaded
+    #
+    def getAggregateTables(self, year, month, res, dataset):
+        key = (year, month, res)
+        with self.lock:
+            tables = self.aggregateTables.get(key)
+            if tables is not None and tables.dataset is dataset: return tables
+        tables = AggregateTables(dataset)
+        with self.lock:
+            if self.hasDataSet(year, month, res) and self.data[year][month][res] is dataset:
+                if key in self.aggregateTables: self.loadedBytes -= self.aggregateTables[key].nbytes
+                self.aggregateTables[key] = tables
+                self.loadedBytes += tables.nbytes
+                self.evict(key)
+        return tables
+
+    #
+    # Mark a loaded data set as the most recently used
+    #
+    def touch(self, year, month, res):
+        key = (year, month, res)
+        with self.lock:
+            if key in self.lru: del self.lru[key]
+            self.lru[key] = True
 
+    #
+    # Pinned data sets are never unloaded.  A data set is pinned if its resolution
+    # is in pinnedResolutions or it has been pinned explicitly
+    #
+    def pin(self, year, month, res):
+        self.pinned.add((year, month, res))
+
+    def unpin(self, year, month, res):
+        self.pinned.discard((year, month, res))
+
+    def isPinned(self, year, month, res):
+        return res in pinnedResolutions or (year, month, res) in self.pinned
+
+    #
+    # Unload a data set.  We just drop our reference: a request which is still
+    # reading it keeps it alive, and the mapping is closed when the last reference goes
+    #
+    def unloadDataSet(self, year, month, res):
+        with self.lock:
+            if not self.hasDataSet(year, month, res): return
+            dataset = self.data[year][month][res]
+            del self.data[year][month][res]
+            if not self.data[year][month]: del self.data[year][month]
+            if not self.data[year]: del self.data[year]
+            if (year, month, res) in self.lru: del self.lru[(year, month, res)]
+            self.loadedBytes -= dataset.nbytes
+            if (year, month, res) in self.aggregateTables:
+                self.loadedBytes -= self.aggregateTables.pop((year, month, res)).nbytes
+
+    #
+    # Unload least recently used, unpinned data sets until we are within the
+    # memory budget.  The most recently used data set, and keep, are never
+    # unloaded, so a data set bigger than the budget can still be served
+    #
+    def evict(self, keep = None):
+        with self.lock:
+            if self.loadedBytes <= self.memoryBudget: return
+            candidates = [key for key in self.lru.keys()[:-1] if not self.isPinned(*key) and key != keep]
+            for (year, month, res) in candidates:
+                if self.loadedBytes <= self.memoryBudget: break
+                self.unloadDataSet(year, month, res)
+
+    #
+    # Bytes of cell data held by the loaded data sets (packed data sets hold
+    # four cells in three bytes)
+    #
     def getSize(self):
-        return sum([len(self.data[year][month][res]) for year in self.data for month in self.data[year] for res in self.data[year][month]])
+        return self.loadedBytes
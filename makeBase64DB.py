@@ -1,22 +1,36 @@
 #!/usr/bin/python
 from mapping import *
+import os
+import json
+import re
+import hashlib
+import numpy
+from multiprocessing import Pool
+from config import dataDirectory, encoderMaxX, encoderMaxY
+from datasetFile import writeDataSet, isBinaryDataSetFile, openDataSet, PackedDataSet, formatVersion
+from deriveResolutions import deriveDataSet
+from timeSeries import buildTimeSeriesIndex, timeSeriesFileName
+from loadManager import getFileVersion, getDerivedVersion, readManifestFile, getManifestDigest, manifestFormatVersion
 
-def zeroVector(n):
-    return [base64[0] for i in range(0, n)]
-
-def makeBase64(year, month, pointsPerDegree, base64Encoder):
-    resultVector = zeroVector(fullSetSize(pointsPerDegree))
-    for data in pm25[year][month][pointsPerDegree]:
-        datasetIndex = DatasetIndex(Coordinate(data[0], data[1]), offsetComputers[pointsPerDegree])
-        base64Index = base64Encoder.encode(data[2])
-        resultIndex = datasetIndex.indexIntoDataSet()
-        try:
-            resultVector[resultIndex] = base64[base64Index]
-        except IndexError:
-            reportStr = 'Index Error: year %d. month %d, data set index %s, data set values %s, base64Index %d'
-            values = (year, month, resultIndex, repr(datasetIndex), base64Index)
-            print reportStr % values
-    return ''.join(resultVector)
+#
+# Scatter points, an n x 3 array of [lon, lat, value] with lon and lat in tenths
+# of degrees, into a data set at pointsPerDegree: the points are converted to
+# indices and encoded as arrays, and assigned to the grid at once.  Returns the
+# data set's symbol values.  Points whose index is off the grid are reported and
+# dropped
+#
+def scatterPoints(points, pointsPerDegree, base64Encoder, datasetSpecifier):
+    offsetComputer = offsetComputers[pointsPerDegree]
+    resultIndices = offsetComputer.getIndicesIntoDataSet(points[:, 0], points[:, 1])
+    symbols = base64Encoder.encodeArray(points[:, 2])
+    outOfRange = resultIndices >= fullSetSize(pointsPerDegree)
+    for i in numpy.flatnonzero(outOfRange):
+        datasetIndex = DatasetIndex(Coordinate(points[i, 0], points[i, 1]), offsetComputer)
+        reportStr = 'Index Error: %s, data set index %s, data set values %s, base64Index %d'
+        print reportStr % (datasetSpecifier, resultIndices[i], repr(datasetIndex), symbols[i])
+    resultVector = numpy.zeros(fullSetSize(pointsPerDegree), dtype=numpy.uint8)
+    resultVector[resultIndices[~outOfRange]] = symbols[~outOfRange]
+    return resultVector
 
 def parseAndCheck(aPointAsList, datasetSpecifier):
     if (not aPointAsList ):
@@ -43,25 +57,46 @@ def parseAndCheck(aPointAsList, datasetSpecifier):
 
 
 
+#
+# Read the points of a CSV file (lon,lat,value per line, lon and lat in tenths of
+# degrees) as an n x 3 array.  The whole file is parsed by numpy in one go, and the
+# points are checked as arrays; only the lines which fail a check go through
+# parseAndCheck, which reports them.  If the file doesn't parse as three numbers
+# per line, every line goes through parseAndCheck
+#
+def readPoints(fileName, datasetSpecifier):
+    csvfile = open(fileName, 'r')
+    text = csvfile.read().strip()
+    csvfile.close()
+    lines = text.splitlines() if text else []
+    points = numpy.fromstring(text.replace('\n', ','), dtype=numpy.float64, sep=',') if text else numpy.zeros(0)
+    if len(points) != 3 * len(lines):
+        checked = [parseAndCheck(line.split(','), datasetSpecifier) for line in lines]
+        return numpy.array([point for (error, point) in checked if not error], dtype=numpy.float64).reshape(-1, 3)
+    points = points.reshape(-1, 3)
+    good = ((points[:, 0] == numpy.floor(points[:, 0])) & (points[:, 1] == numpy.floor(points[:, 1])) &
+            (numpy.abs(points[:, 0]) <= 1800) & (numpy.abs(points[:, 1]) <= 900) & (points[:, 2] >= 0))
+    for i in numpy.flatnonzero(~good):
+        parseAndCheck(lines[i].split(','), datasetSpecifier)
+    return points[good]
+
+def csvFileName(year, month, res):
+    return 'newPM25/%d_%d_%d.csv' % (year, month, res)
+
+#
+# The symbol values of a year/month/res, from its CSV file
+#
+def encodeYearMonthRes(year, month, res, base64Encoder):
+    datasetSpecifier = 'year = %d, month=%s, res=%d' % (year, month, res)
+    points = readPoints(csvFileName(year, month, res), datasetSpecifier)
+    return scatterPoints(points, res, base64Encoder, datasetSpecifier)
+
 #
 # Do a year/month/res triple
 #
 def base64EncodeYearMonthRes(year, month, res, base64Encoder, outfile):
-    csvfile = open('newPM25/%d_%d_%d.csv' % (year, month, res), 'r')
-    resultVector = zeroVector(fullSetSize(res))
-    line = csvfile.readline()
-    datasetSpecifier = 'year = %d, month=%s, res=%d' % (year, month, res)
-    offsetComputer = offsetComputers[res]
-    while (len(line) > 0):
-        dataAsList = line.split(',')
-        (error, aPointAsList) = parseAndCheck(dataAsList, datasetSpecifier)
-        if (error): continue
-        datasetIndex = DatasetIndex(Coordinate(aPointAsList[0], aPointAsList[1]), offsetComputer)
-        base64Index = base64Encoder.encode(aPointAsList[2])
-        resultIndex = datasetIndex.indexIntoDataSet()
-        resultVector[resultIndex] = base64[base64Index]
-    outfile.write('data[%d][%d][%d] = "%s"\n' % (year, month, res, ''.join(resultVector)))
-    csvfile.close()
+    values = encodeYearMonthRes(year, month, res, base64Encoder)
+    outfile.write('data[%d][%d][%d] = "%s"\n' % (year, month, res, encodeSymbols(values)))
 
 #
 # Do a Month
@@ -88,17 +123,6 @@ fullMonths = range(1, 13)
 partYears = [{'year': 1997, 'months': range(9, 13)}, {'year':2015, 'months': [1]}]
 resolutions = [1, 2, 4, 10]
 
-offsetComputers = {
-    4: OffsetComputer(4, [0, 2, 4, 7, 9]),
-    2: OffsetComputer(2, [0, 5]),
-    1: OffsetComputer(1, [9]),
-    10: OffsetComputer(10, range(0, 10))
-}
-
-
-
-def getYear(aYear, months, base64Encoder):
-    return [{'month': month, 'res':res, 'data': makeBase64(aYear, month, res, base64Encoder)} for month in months for res in resolutions]
 
 
 def getFile(aYear):
@@ -124,51 +148,203 @@ def printHeader(file, year, months):
     file.write(result)
     file.write('\n')
 
-def genYear(aYear, months, base64Encoder):
-    file = getFile(aYear)
-    global pm25
-    pm25[aYear] = {}
-    for month in months:
-        execfile('newPM25/%d_%d.py' % (aYear, month))
-    printHeader(file, aYear, months)
-    result = getYear(aYear, months, base64Encoder)
-    for value in result:
-        file.write('data[%d][%d][%d] = "%s"\n' % (aYear, value['month'], value['res'], value['data']))
-    file.close()
-
-def doRes(aYear, aMonth, res, base64Encoder, file):
-    file.write('data[%d][%d][%d] = "%s"\n' % (aYear, aMonth, res, makeBase64(aYear, aMonth, res, base64Encoder)))
-
-def doMonth(aYear, aMonth, base64Encoder, file):
-    for res in [1, 2, 4, 10]:
-        doRes(aYear, aMonth, res, base64Encoder, file)
-    pm25[aYear][aMonth] = {}
-
-
 def doYear(aYear, months, base64Encoder):
-    file = getFile(aYear)
-    global pm25
-    pm25[aYear] = {}
-    printHeader(file, aYear, months)
-    for month in months:
-        execfile('newPM25/%d_%d.py' % (aYear, month))
-        doMonth(aYear, month, base64Encoder, file)
-    pm25[aYear] = {}
-    file.close()
+    base64EncodeYear(aYear, months, base64Encoder)
 
 def doYears(yearList):
-    base64Encoder = Base64Encoder(60, 60)
-    global pm25
-    pm25 = {}
+    base64Encoder = Base64Encoder(encoderMaxX, encoderMaxY)
     for year in yearList:
         doYear(year, fullMonths, base64Encoder)
 
 
-def fullDB():
-    base64Encoder = Base64Encoder(60, 60)
-    global pm25
-    pm25 = {}
-    for year in years:
-        doYear(year, fullMonths, base64Encoder)
-    for partYear in partYears:
-        doYear(partYear['year'], partYear['months'], base64Encoder)
+#
+# Build (or bring up to date) the whole archive; see buildDB
+#
+def fullDB(processes = None):
+    buildDB(allDataSets(), processes)
+
+#
+# The (year, month, res) of every data set in the archive
+#
+def allDataSets():
+    yearMonths = [(year, month) for year in years for month in fullMonths]
+    yearMonths += [(partYear['year'], month) for partYear in partYears for month in partYear['months']]
+    return [(year, month, res) for (year, month) in sorted(yearMonths) for res in resolutions]
+
+#
+# Incremental builds.  Each manifest record also says what the data set was built
+# from: 'source', the SHA-1 of its CSV file, and 'encoder', the encoder
+# parameters.  A data set is rebuilt only if one of these has changed (or its file
+# is missing).  Its 'version' is a hash of them, which the server uses for ETags
+# and cache keys (see DataManager.getVersion), and is part of the file name, so a
+# rebuilt data set is a new file: a running server keeps reading the files its
+# manifest names until it restarts, and the new manifest is published with a
+# rename.  removeUnpublished deletes the files no manifest names any more
+#
+encoderParams = [encoderMaxX, encoderMaxY]
+dataSetFilePattern = re.compile(r'^\d+_\d+_\d+\.[0-9a-f]+\.bin$')
+
+def hashFile(fileName):
+    digest = hashlib.sha1()
+    f = open(fileName, 'rb')
+    for block in iter(lambda: f.read(1 << 20), ''):
+        digest.update(block)
+    f.close()
+    return digest.hexdigest()
+
+def getSourceHash(dataSetKey):
+    return (dataSetKey, hashFile(csvFileName(*dataSetKey)))
+
+def getBuildVersion(sourceHash):
+    return hashlib.sha1(json.dumps([sourceHash, encoderParams, formatVersion])).hexdigest()[:16]
+
+def isUpToDate(record, sourceHash):
+    return (record.get('source') == sourceHash and record.get('encoder') == encoderParams and
+            os.path.exists(dataDirectory + '/' + record['file']))
+
+#
+# Build one data set from its CSV file, in the packed binary format, to
+# dataDirectory/<year>_<month>_<res>.<version>.bin.  The file is written under a
+# temporary name and renamed, so nothing ever sees half of it.  Returns its
+# manifest record.  This runs in the worker processes of buildDB
+#
+def buildDataSet(job):
+    ((year, month, res), sourceHash) = job
+    values = encodeYearMonthRes(year, month, res, Base64Encoder(encoderMaxX, encoderMaxY))
+    version = getBuildVersion(sourceHash)
+    fileName = '%d_%d_%d.%s.bin' % (year, month, res, version)
+    writeDataSet(dataDirectory + '/' + fileName + '.tmp', year, month, res, encodeSymbols(values))
+    os.rename(dataDirectory + '/' + fileName + '.tmp', dataDirectory + '/' + fileName)
+    return {'year': year, 'month': month, 'res': res, 'file': fileName, 'version': version,
+            'source': sourceHash, 'encoder': encoderParams}
+
+#
+# The records of the published manifest (see loadManager.readManifestFile), and
+# its generation: 0 if there is none yet
+#
+def readManifestAndGeneration():
+    if not os.path.exists(dataDirectory + '/manifest.json'): return ([], 0)
+    (header, records) = readManifestFile(dataDirectory + '/manifest.json')
+    return (records, header['generation'])
+
+def readManifest():
+    return readManifestAndGeneration()[0]
+
+#
+# Publish a manifest of records, as the next generation after the published one:
+# write it under a temporary name and rename it over manifest.json, so a server
+# starting up reads either the old one or the new one
+#
+def writeManifest(records):
+    generation = readManifestAndGeneration()[1] + 1
+    manifest = {'formatVersion': manifestFormatVersion, 'generation': generation,
+                'digest': getManifestDigest(records), 'dataSets': records}
+    manifestFile = open(dataDirectory + '/manifest.json.tmp', 'w')
+    manifestFile.write(json.dumps(manifest))
+    manifestFile.close()
+    os.rename(dataDirectory + '/manifest.json.tmp', dataDirectory + '/manifest.json')
+
+#
+# Build the data sets in dataSetKeys (by default the whole archive) from the CSV
+# files straight to the binary format the server reads, with a pool of processes
+# (by default one per CPU), one data set per task.  The CSV files are hashed (in
+# the pool) first, and only the data sets whose inputs have changed are built,
+# unless force is True.  The manifest is published as each data set is finished,
+# so an interrupted build keeps what it has done
+#
+def buildDB(dataSetKeys = None, processes = None, force = False):
+    if dataSetKeys is None: dataSetKeys = allDataSets()
+    keyOf = lambda record: (record['year'], record['month'], record['res'])
+    records = dict([(keyOf(record), record) for record in readManifest()])
+    pool = Pool(processes)
+    try:
+        sourceHashes = dict(pool.map(getSourceHash, dataSetKeys))
+        jobs = [(key, sourceHashes[key]) for key in dataSetKeys
+                if force or not key in records or not isUpToDate(records[key], sourceHashes[key])]
+        print '%d of %d data sets to build' % (len(jobs), len(dataSetKeys))
+        for record in pool.imap_unordered(buildDataSet, jobs):
+            records[keyOf(record)] = record
+            writeManifest([records[key] for key in sorted(records.keys())])
+            print 'Built %s' % record['file']
+    finally:
+        pool.close()
+        pool.join()
+    updateTimeSeries([key for (key, sourceHash) in jobs], records)
+
+#
+# Rebuild the time series indexes which the data sets in builtKeys have changed:
+# those at the resolutions built, and, for a month whose res 10 was built, those at
+# the resolutions derived from it.  Only indexes which exist are rebuilt
+#
+def updateTimeSeries(builtKeys, records):
+    changed = set()
+    for (year, month, res) in builtKeys:
+        changed.add(res)
+        if res == 10: changed.update([aRes for aRes in resolutions if not (year, month, aRes) in records])
+    changed = [res for res in sorted(changed) if os.path.exists(timeSeriesFileName(dataDirectory, res))]
+    if changed:
+        print 'Rebuilding the time series indexes for res %s' % ', '.join([str(res) for res in changed])
+        buildTimeSeries(changed)
+
+#
+# Delete the data set files buildDB wrote which manifest.json no longer names.
+# Only do this once no server is still running with an older manifest
+#
+def removeUnpublished():
+    published = set([record['file'] for record in readManifest()])
+    for fileName in os.listdir(dataDirectory):
+        if dataSetFilePattern.match(fileName) and not fileName in published:
+            os.remove(dataDirectory + '/' + fileName)
+
+#
+# Convert the data sets listed in manifest.json to the packed binary,
+# memory-mappable format in datasetFile.py.  Legacy files (just the base64
+# string) foo are written to foo.bin, and binary files with one symbol per
+# byte are repacked in place.  The manifest is rewritten to point at the new
+# files.  Files which are already packed are left alone.  If res10Only is True, the
+# res 1, 2 and 4 entries are dropped from the manifest, and the server derives
+# those resolutions from res 10 (see deriveResolutions.py)
+#
+def convertToBinary(res10Only = False):
+    manifest = readManifest()
+    if res10Only:
+        manifest = [record for record in manifest if record['res'] == 10]
+    for record in manifest:
+        fileName = dataDirectory + '/' + record['file']
+        dataset = openDataSet(fileName)
+        if isinstance(dataset, PackedDataSet) and isBinaryDataSetFile(fileName):
+            dataset.close()
+            continue
+        base64String = dataset[:]
+        dataset.close()
+        if not isBinaryDataSetFile(fileName):
+            record['file'] = record['file'] + '.bin'
+        outputFile = dataDirectory + '/' + record['file']
+        writeDataSet(outputFile + '.tmp', record['year'], record['month'], record['res'], base64String)
+        os.rename(outputFile + '.tmp', outputFile)
+    writeManifest(manifest)
+
+#
+# Build the time-major indexes (see timeSeries.py) of the data sets in the
+# manifest, for the resolutions in resList.  A month with res 10 but not res is
+# indexed at res too, with res derived from res 10 as the server does.  Each
+# month's data set version is recorded in the index, worked out as the server does
+#
+def buildTimeSeries(resList = resolutions):
+    manifest = readManifest()
+    keyOf = lambda record: (record['year'], record['month'], record['res'])
+    files = dict([(keyOf(record), dataDirectory + '/' + record['file']) for record in manifest])
+    versions = dict([(keyOf(record), str(record['version'])) for record in manifest if 'version' in record])
+    def getVersion(year, month, res):
+        if (year, month, res) in versions: return versions[(year, month, res)]
+        return getFileVersion(files[(year, month, res)])
+    for res in resList:
+        months = sorted(set([(year, month) for (year, month, aRes) in files if aRes == res or aRes == 10]))
+        def openMonth(year, month):
+            if (year, month, res) in files: return openDataSet(files[(year, month, res)])
+            return deriveDataSet(openDataSet(files[(year, month, 10)]), res)
+        def getMonthVersion(year, month):
+            if (year, month, res) in files: return getVersion(year, month, res)
+            return getDerivedVersion(getVersion(year, month, 10), res)
+        monthVersions = [getMonthVersion(year, month) for (year, month) in months]
+        buildTimeSeriesIndex(months, monthVersions, openMonth, res, timeSeriesFileName(dataDirectory, res))
@@ -1,8 +1,25 @@
 import sys
 import math
+import numpy
 
 base64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 
+#
+# Lookup tables between base64 symbols (as bytes) and their values 0-63.
+# symbolValues maps a byte to its value, or 255 if it isn't a base64 symbol
+#
+symbolTable = numpy.frombuffer(base64, dtype=numpy.uint8).copy()
+symbolValues = numpy.empty(256, dtype=numpy.uint8)
+symbolValues.fill(255)
+symbolValues[symbolTable] = numpy.arange(64, dtype=numpy.uint8)
+
+#
+# Encode an array of symbol values (of any shape) as a base64 string, in
+# row-major order
+#
+def encodeSymbols(values):
+    return symbolTable[values].tostring()
+
 #
 # A Hybrid encoder.  This encodes according to the formula
 # y = (maxY/maxX) * x for 0 <= x <= maxX
@@ -49,41 +66,111 @@ class Base64Encoder:
             ceilX = 1 << 30 # infinity...
         return {'min': minX, 'max': ceilX}
 
+    #
+    # encode for a numpy array of values, returning a uint8 array of symbol
+    # values.  Same formula as encode: round half away from zero in the linear
+    # range, int(aValue).bit_length() (which is the frexp exponent) above it
+    #
+    def encodeArray(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        linear = numpy.floor(self.slope * values + 0.5)
+        exponent = numpy.frexp(numpy.floor(numpy.maximum(values, 1)))[1]
+        logarithmic = numpy.minimum(exponent - self.bitOffset + self.maxY, 63)
+        result = numpy.where(values <= self.maxX, linear, logarithmic)
+        result[values < 0] = 0
+        return result.astype(numpy.uint8)
+
+    #
+    # The midpoint of getXRange for every symbol value, as an array indexed by
+    # symbol value.  Used to turn symbols back into approximate physical values.
+    # The range for 63 is open-ended (its max is "infinity"), so for 63 we take
+    # the midpoint of [min, 2 * min), as for the other logarithmic symbols
+    #
+    def getMidpoints(self):
+        ranges = [self.getXRange(aYVal) for aYVal in range(64)]
+        ranges[63] = {'min': ranges[63]['min'], 'max': 2 * ranges[63]['min']}
+        midpoints = [max(0, (aRange['min'] + aRange['max']) / 2.0) for aRange in ranges]
+        return numpy.array(midpoints, dtype=numpy.float64)
+
 
 
 def fullSetSize(pointsPerDegree):
     return 360 * 180 * pointsPerDegree * pointsPerDegree
 
 #
-# Initialize the parameters
+# Initialize the parameters.  The mapping between tenths of degrees and row or
+# column indices is worked out once, here, for every tenth of a degree of
+# latitude (-900 to 900) and longitude (-1800 to 1800) and every row and column,
+# and kept in lookup arrays; the conversions below just index them, one value or
+# a whole array of values at a time
 #
 class OffsetComputer:
     def __init__(self, pointsPerDegree, offsetData):
         self.offsets = offsetData
         self.pointsPerDegree = pointsPerDegree
+        self.offsetIndices = numpy.array([self.computeIndexOffset(offset) for offset in range(10)])
+        latTenths = numpy.arange(1801)
+        lonTenths = numpy.arange(3601)
+        self.rowIndices = (latTenths / 10) * pointsPerDegree + self.offsetIndices[latTenths % 10]
+        self.colIndices = (lonTenths / 10) * pointsPerDegree + self.offsetIndices[lonTenths % 10]
+        self.latitudes = self.computeLatsOrLonsFromIndices(numpy.arange(180 * pointsPerDegree), -900)
+        self.longitudes = self.computeLatsOrLonsFromIndices(numpy.arange(360 * pointsPerDegree), -1800)
 
     #
     # get the index of the offset corresponding to aDegreeOffset (a tenth
     # of a degree).  This is the amount to add to the index we get from a
-    # degree
+    # degree.  computeIndexOffset does the search, for the lookup array
     #
 
-    def getIndexOffset(self, aDegreeOffset):
+    def computeIndexOffset(self, aDegreeOffset):
         if aDegreeOffset in self.offsets:
             return self.offsets.index(aDegreeOffset)
         for index, elem in enumerate(self.offsets):
             if (elem > aDegreeOffset): return index - 1
         return self.pointsPerDegree - 1
 
+    def getIndexOffset(self, aDegreeOffset):
+        return int(self.offsetIndices[int(math.floor(aDegreeOffset))])
+
+    #
+    # The row index for a latitude and the column index for a longitude, in tenths
+    # of degrees (integers, clamped to the globe as Coordinate does).  These are the indices
+    # DatasetIndex computes.  The plural versions take and return numpy arrays
+    #
+    def getRowIndex(self, aLat):
+        return int(self.rowIndices[int(math.floor(min(900, max(-900, aLat)))) + 900])
+
+    def getColIndex(self, aLon):
+        return int(self.colIndices[int(math.floor(min(1800, max(-1800, aLon)))) + 1800])
+
+    def getRowIndices(self, lats):
+        return self.rowIndices[numpy.floor(numpy.clip(lats, -900, 900)).astype(numpy.int64) + 900]
+
+    def getColIndices(self, lons):
+        return self.colIndices[numpy.floor(numpy.clip(lons, -1800, 1800)).astype(numpy.int64) + 1800]
+
+    #
+    # The indices into the data set for arrays of longitudes and latitudes, as
+    # DatasetIndex.indexIntoDataSet gives them for a single point
+    #
+    def getIndicesIntoDataSet(self, lons, lats):
+        indices = self.getRowIndices(lats) * (360 * self.pointsPerDegree) + self.getColIndices(lons)
+        return numpy.maximum(indices, 0)
+
     #
     # given a row or column index, return the latitude/longitude
-    # in tenths of degrees
+    # in tenths of degrees.  computeLatsOrLonsFromIndices does the same for an
+    # array of indices
     #
     def computeLatOrLonFromIndex(self, aRowOrColIndex, minValue):
         numDegrees = int(math.floor(aRowOrColIndex/self.pointsPerDegree))
         offsetIndex = aRowOrColIndex % self.pointsPerDegree
         return minValue + 10 * numDegrees + self.offsets[offsetIndex]
 
+    def computeLatsOrLonsFromIndices(self, indices, minValue):
+        offsets = numpy.array(self.offsets)
+        return minValue + 10 * (indices / self.pointsPerDegree) + offsets[indices % self.pointsPerDegree]
+
     #
     # Return the lat/lon for a given index into the dataset.  This is the
     # inverse of the computation that DatasetIndex does.  As always, we will
@@ -97,9 +184,25 @@ class OffsetComputer:
         rowIndex = int(math.floor(anIndexIntoDataSet/(360 * self.pointsPerDegree)))
         # The column index is just what's left over
         colIndex = anIndexIntoDataSet - 360 * self.pointsPerDegree * rowIndex
-        latitude = self.computeLatOrLonFromIndex(rowIndex, -900)
-        longitude = self.computeLatOrLonFromIndex(colIndex, -1800)
-        return {'lat': latitude, 'lon': longitude}
+        return {'lat': int(self.latitudes[rowIndex]), 'lon': int(self.longitudes[colIndex])}
+
+    #
+    # getCoordinateForIndex for an array of indices: 'lat' and 'lon' are arrays
+    #
+    def getCoordinatesForIndices(self, indices):
+        (rowIndices, colIndices) = numpy.divmod(numpy.asarray(indices), 360 * self.pointsPerDegree)
+        return {'lat': self.latitudes[rowIndices], 'lon': self.longitudes[colIndices]}
+
+#
+# The offset computers for each resolution, shared by the builder and the server.
+# The offsets are the tenth-of-a-degree offsets at which the points in a degree sit
+#
+offsetComputers = {
+    4: OffsetComputer(4, [0, 2, 4, 7, 9]),
+    2: OffsetComputer(2, [0, 5]),
+    1: OffsetComputer(1, [9]),
+    10: OffsetComputer(10, range(0, 10))
+}
 
 #
 # A Coordinate, just a lat/lon pair.  Here and everywhere these are integers
@@ -137,10 +240,8 @@ class DatasetIndex:
     # given a number of points per degree. The dataset
     #
     def __init__(self, aCoordinate, offsetComputer):
-        self.rowIndex =  aCoordinate.latDegree * offsetComputer.pointsPerDegree
-        self.rowIndex += offsetComputer.getIndexOffset(aCoordinate.latOffset)
-        self.colIndex = aCoordinate.lonDegree * offsetComputer.pointsPerDegree
-        self.colIndex += offsetComputer.getIndexOffset(aCoordinate.lonOffset)
+        self.rowIndex = offsetComputer.getRowIndex(aCoordinate.lat)
+        self.colIndex = offsetComputer.getColIndex(aCoordinate.lon)
         self.pointsPerDegree  = offsetComputer.pointsPerDegree
 
 
@@ -255,30 +356,52 @@ class BoundingBox:
 # these are four scalar variables.  Latitude is given in the
 # conventional range, (-89.9 to 89.9), where -89.9 is the South Pole and
 # 89.9 is the north pole.  Similarly, -179.9 is just east of the dateline,
-# 179.9 is just west of the dateline.  This routine returns a list of
-# strings, one per row.  The subsequent method returns as a single string
+# 179.9 is just west of the dateline.  This routine returns the data as a
+# 2-D numpy array of symbol values, one row per latitude, in 'values': a
+# strided slice of the data set's grid, or, when the box crosses the dateline,
+# two slices (from the west edge to the dateline, then from the dateline to
+# the east edge) side by side.  Nothing is encoded until encodeSymbols is called
 #
 
-def getDataAsSequences(north, south, west, east, offsetComputer, dataSet, optimizeSingleRectangleCase = True):
+def getDataAsArray(north, south, west, east, offsetComputer, dataSet):
     bbox = BoundingBox(north, south, west, east, offsetComputer)
-    indexSet = bbox.getIndexSequences(optimizeSingleRectangleCase)
-    sequences = [dataSet[sn['firstIndex']:sn['lastIndex']] for sn in indexSet]
-    firstCoordinate = offsetComputer.getCoordinateForIndex(indexSet[0]['firstIndex'])
-    pointsPerRow = bbox.indexesPerRow()
-    return {'swCorner': firstCoordinate, 'pointsPerRow': pointsPerRow, 'pointsPerDegree': offsetComputer.pointsPerDegree, 'sequences': sequences}
+    pointsPerRow = bbox.swIndex.pointsPerRow()
+    firstRow = max(bbox.swIndex.rowIndex, 0)
+    lastRow = bbox.neIndex.rowIndex + 1
+    firstCol = bbox.swIndex.colIndex
+    lastCol = bbox.neIndex.colIndex + 1
+    if firstCol < 0:
+        # crosses the dateline (see BoundingBox)
+        values = numpy.hstack([dataSet.getBlock(firstRow, lastRow, firstCol + pointsPerRow, pointsPerRow),
+                               dataSet.getBlock(firstRow, lastRow, 0, lastCol)])
+        firstCol += pointsPerRow
+    else:
+        values = dataSet.getBlock(firstRow, lastRow, firstCol, lastCol)
+    firstCoordinate = {'lat': offsetComputer.computeLatOrLonFromIndex(firstRow, -900),
+                       'lon': offsetComputer.computeLatOrLonFromIndex(firstCol, -1800)}
+    return {'swCorner': firstCoordinate, 'pointsPerRow': values.shape[1], 'pointsPerDegree': offsetComputer.pointsPerDegree, 'values': values}
+
+#
+# As getDataAsArray, but the data is returned as a list of strings in
+# 'sequences', one per row.  If optimizeSingleRectangleCase is True and the box
+# spans the globe E-W, there is a single string for the whole box
+#
+def getDataAsSequences(north, south, west, east, offsetComputer, dataSet, optimizeSingleRectangleCase = True):
+    result = getDataAsArray(north, south, west, east, offsetComputer, dataSet)
+    values = result['values']
+    if optimizeSingleRectangleCase and result['pointsPerRow'] >= 360 * offsetComputer.pointsPerDegree:
+        result['sequences'] = [encodeSymbols(values)]
+    else:
+        result['sequences'] = [encodeSymbols(row) for row in values]
+    return result
 #
 # Get the data from dataset for the bounding box given by
 # (nw, se) where each is given by a pair (lat, long).  This returns the result
-# from getData as a single string, which is what will generally be used; a routine
+# from getDataAsArray as a single string, which is what will generally be used; a routine
 # which calls getDataAsSequences directly does it to support human-readability for debugging.
 #
 
 def getData(north, south, west, east, offsetComputer, dataSet):
-    result = getDataAsSequences(north, south, west, east, offsetComputer, dataSet)
-    result['base64String'] = ''.join(result['sequences'])
+    result = getDataAsArray(north, south, west, east, offsetComputer, dataSet)
+    result['base64String'] = encodeSymbols(result['values'])
     return result
-
-
-        
-            
-                                       
\ No newline at end of file
@@ -6,8 +6,19 @@
 #
 from os import listdir
 from os.path import isfile, join
-from config import dataDirectory
+from config import dataDirectory, lodAggregation, streamChunkCells
 from loadManager import DataManager
+from mapping import encodeSymbols
+from rectangles import getRectangleArray, formatRectangles, mergeModes
+from delta import findChangedSpans
+from polygons import getMask
+import numpy
+#
+# A data set's key, for messages
+#
+def convertToString(year, month, res):
+    return 'year=%d, month=%d, res=%d' % (year, month, res)
+
 #
 # Utility to check that a query is OK.  This should be called
 # only when we haven't checked previously.  This checks to make sure
@@ -28,24 +39,178 @@ def checkQuery(dataManager, year, month, res, nwLat, seLat, nwLon, seLon):
 #
 # Pull the dataset from the data manager, returning either the data set with the
 # requested resolution, or, if that is not available but loadable, the best loaded
-# resolution and kick off the load request so the next request for this data will hit
+# resolution and kick off the load request so the next request for this data will hit.
+# waitMs is the policy for a miss: wait up to waitMs milliseconds for the requested
+# resolution to load before falling back to the best loaded resolution (0, the
+# default, falls back immediately).  If nothing is loaded for the month we wait for
+# the requested resolution.  Returns the pair (resolution served, dataset)
 #
-def getBestAvailableData(dataManager, year, month, res):
+def getBestAvailableData(dataManager, year, month, res, waitMs = 0):
     if dataManager.hasDataSet(year, month, res):
         return res, dataManager.getData(year, month, res)
-    bestRes = dataManager.bestResolution(year, month)
-    result = dataManager.getData(year, month, bestRes)
     if dataManager.checkLoadable(year, month, res):
-        dataManager.asynchLoad(year, month, res)
-    return bestRes, result
+        future = dataManager.asynchLoad(year, month, res)
+        if waitMs > 0 and future.wait(waitMs / 1000.0) and future.error is None:
+            return res, future.dataset
+    bestRes = dataManager.bestResolution(year, month)
+    if bestRes is None:
+        return res, dataManager.getData(year, month, res)
+    return bestRes, dataManager.getData(year, month, bestRes)
+
+#
+# Actually Search the DB for a matching string.  No checking: call first if
+# you want this checked.  Result is a 2-D array of symbol values in 'values',
+# which the caller encodes (encodeSymbols gives the base64 string, row-major
+# order) when it serializes the result.  The result records the resolution
+# served in 'res', the one asked for in 'requestedRes' and the one planned in
+# 'plannedRes': the requested one, or, if maxPoints is given, the one
+# planLevelOfDetail picks so the result has at most maxPoints cells.  A result
+# whose res is below plannedRes is a fallback, the planned one not being loaded
+#
+def searchDB(dataManager, year, month, res, north, south, west, east, waitMs = 0, maxPoints = None):
+    targetRes = res
+    if maxPoints is not None:
+        targetRes = planLevelOfDetail(dataManager, year, month, res, north, south, west, east, maxPoints)[0]
+    dataManager.recordAccess(year, month, targetRes)
+    servedRes, dataset = getBestAvailableData(dataManager, year, month, targetRes, waitMs)
+    result = getDataAsArray(north, south, west, east, servedRes, dataset)
+    result.update({'res': servedRes, 'requestedRes': res, 'plannedRes': targetRes})
+    if maxPoints is not None: applyLevelOfDetail(result, maxPoints)
+    return result
 
 #
 # Actually Search the DB for a matching string.  No checking: call first if
-# you want this checked.  Result is a String, row-major order
+# you want this checked.  Result is a list of sequences, one per row.
+# optimizeSingleRectangleCase is accepted for compatibility with searchBase64DB;
+# rows are always returned separately here
+#
+def searchDBReturnRows(dataManager, year, month, res, north, south, west, east, optimizeSingleRectangleCase, waitMs = 0, maxPoints = None):
+    result = searchDB(dataManager, year, month, res, north, south, west, east, waitMs, maxPoints)
+    result['sequences'] = [encodeSymbols(row) for row in result['values']]
+    return result
+
+#
+# The changes in a box between (baseYear, baseMonth) and (year, month): searchDB
+# for (year, month) plus 'spans', the (starts, stops) of the changed cells (see
+# delta.py), against the base month's data set at the resolution served, which the
+# client must have.  The base is resolved like the month itself, with the same
+# wait, and searched the same way (at the same stride, if maxPoints is given) so
+# both are in the same index space.  The client holds its base at the planned
+# resolution, so if the month isn't served at it, or the base isn't loaded at it
+# in time, there is no delta: 'spans' is None and the result is a 'fallback'
+#
+def searchDelta(dataManager, year, month, res, baseYear, baseMonth, north, south, west, east, waitMs = 0, maxPoints = None):
+    result = searchDB(dataManager, year, month, res, north, south, west, east, waitMs, maxPoints)
+    baseRes, baseDataSet = getBestAvailableData(dataManager, baseYear, baseMonth, result['res'], waitMs)
+    if result['res'] != result['plannedRes'] or baseRes != result['res'] or baseDataSet is None:
+        result.update({'spans': None, 'changed': None, 'fallback': True})
+        return result
+    baseResult = getDataAsArray(north, south, west, east, baseRes, baseDataSet)
+    if maxPoints is not None: applyLevelOfDetail(baseResult, maxPoints)
+    result['spans'] = findChangedSpans(baseResult['values'], result['values'])
+    result['changed'] = int(numpy.count_nonzero(baseResult['values'] != result['values']))
+    return result
+
 #
-def searchDB(dataManager, year, month, res, north, south, west, east):
-    res, dataset = getBestAvailableData(dataManager, year, month, res)
-    return getData(north, south, west, east, res, dataset)
+# The cells inside a GeoJSON polygon (see polygons.py), at the best available
+# resolution.  The result has the mask's spans, with 'spanValues', the symbol
+# values of all the spans' cells one after another, and the block covering the
+# mask's bounding box in 'values' with the cells outside the polygon set to 0.
+# Rows and columns are grid indices.  Raises GeometryError for bad geometry
+#
+def searchPolygon(dataManager, year, month, res, geoJSON, waitMs = 0):
+    dataManager.recordAccess(year, month, res)
+    servedRes, dataset = getBestAvailableData(dataManager, year, month, res, waitMs)
+    (rows, firstCols, lastCols) = getMask(geoJSON, servedRes)
+    result = {'pointsPerDegree': servedRes, 'res': servedRes, 'requestedRes': res, 'spans': (rows, firstCols, lastCols)}
+    if len(rows) == 0:
+        result.update({'swCorner': getCoordinate(0, 0, servedRes), 'pointsPerRow': 0,
+                       'values': numpy.zeros((0, 0), dtype=numpy.uint8), 'spanValues': numpy.zeros(0, dtype=numpy.uint8)})
+        return result
+    (firstRow, firstCol) = (rows.min(), firstCols.min())
+    block = dataset.getBlock(firstRow, rows.max() + 1, firstCol, lastCols.max() + 1)
+    lengths = lastCols - firstCols + 1
+    cellRows = numpy.repeat(rows - firstRow, lengths)
+    cellCols = numpy.repeat(firstCols - firstCol - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+    values = numpy.zeros(block.shape, dtype=numpy.uint8)
+    values[cellRows, cellCols] = block[cellRows, cellCols]
+    result.update({'swCorner': getCoordinate(firstRow, firstCol, servedRes), 'firstRow': int(firstRow), 'firstCol': int(firstCol),
+                   'pointsPerRow': values.shape[1], 'values': values, 'spanValues': block[cellRows, cellCols]})
+    return result
+
+#
+# Streaming searches.  streamDB resolves the data set like searchDB, but reads
+# nothing: the result has the metadata, and iterateRowChunks then reads the block
+# streamChunkCells cells (whole rows) at a time, yielding (first row of the chunk,
+# counted from the south edge of the box, chunk values).  The memory a streamed
+# search needs is a chunk, however big the box
+#
+def streamDB(dataManager, year, month, res, north, south, west, east, waitMs = 0):
+    dataManager.recordAccess(year, month, res)
+    servedRes, dataset = getBestAvailableData(dataManager, year, month, res, waitMs)
+    (firstRow, firstCol) = (getRow(south, servedRes), getCol(west, servedRes))
+    (numRows, numCols) = getBlockShape(north, south, west, east, servedRes)
+    return {'swCorner': getCoordinate(firstRow, firstCol, servedRes), 'pointsPerRow': numCols, 'pointsPerDegree': servedRes,
+            'res': servedRes, 'requestedRes': res, 'dataset': dataset, 'numRows': numRows,
+            'firstRow': max(firstRow, 0), 'firstCol': firstCol, 'lastCol': getCol(east, servedRes)}
+
+def iterateRowChunks(result, chunkCells = streamChunkCells):
+    rowsPerChunk = max(1, chunkCells / max(result['pointsPerRow'], 1))
+    for row in range(0, result['numRows'], rowsPerChunk):
+        firstRow = result['firstRow'] + row
+        lastRow = min(firstRow + rowsPerChunk, result['firstRow'] + result['numRows'])
+        yield (row, result['dataset'].getBlock(firstRow, lastRow, result['firstCol'], result['lastCol']))
+
+#
+# Level of detail.  A client can cap the number of cells it gets with maxPoints.
+# For each resolution up to the requested one, the stride is the smallest s for
+# which taking every s-th row and column of the box (or, with lodAggregation
+# 'max', the max of each s x s block of cells) gives at most maxPoints cells;
+# planLevelOfDetail picks the resolution which gives the most points per degree
+# after striding (the lowest stride on a tie).  Returns (res, stride)
+#
+def getBlockShape(north, south, west, east, res):
+    numRows = max(min(getRow(north, res), 180 * res) - max(getRow(south, res), 0), 0)
+    firstCol = min(max(getCol(west, res), 0), 360 * res)
+    lastCol = min(max(getCol(east, res), 0), 360 * res)
+    numCols = 360 * res - firstCol + lastCol if firstCol > lastCol else lastCol - firstCol
+    return (numRows, numCols)
+
+def getStride(shape, maxPoints):
+    (numRows, numCols) = shape
+    stride = max(1, int(math.ceil(math.sqrt(float(numRows * numCols) / max(maxPoints, 1)))))
+    while (-(-numRows / stride)) * (-(-numCols / stride)) > maxPoints:
+        stride += 1
+    return stride
+
+def planLevelOfDetail(dataManager, year, month, res, north, south, west, east, maxPoints):
+    plans = []
+    for aRes in [aRes for aRes in [1, 2, 4, 10] if aRes <= res and dataManager.checkLoadable(year, month, aRes)]:
+        stride = getStride(getBlockShape(north, south, west, east, aRes), maxPoints)
+        plans.append((float(aRes) / stride, -stride, aRes))
+    if not plans: return (res, 1)
+    (pointsPerDegree, stride, bestRes) = max(plans)
+    return (bestRes, -stride)
+
+#
+# Cut a search result down to at most maxPoints cells, striding (or taking the
+# max over blocks of) its values.  Records the stride in 'stride'; pointsPerDegree
+# becomes res / stride, which need not be a whole number
+#
+def applyLevelOfDetail(result, maxPoints):
+    values = result['values']
+    stride = getStride(values.shape, maxPoints)
+    result['stride'] = stride
+    if stride == 1: return result
+    if lodAggregation == 'max':
+        (numRows, numCols) = (-(-values.shape[0] / stride), -(-values.shape[1] / stride))
+        padded = numpy.zeros((numRows * stride, numCols * stride), dtype=values.dtype)
+        padded[:values.shape[0], :values.shape[1]] = values
+        values = padded.reshape(numRows, stride, numCols, stride).max(axis=3).max(axis=1)
+    else:
+        values = values[::stride, ::stride]
+    result.update({'values': values, 'pointsPerRow': values.shape[1], 'pointsPerDegree': float(result['pointsPerDegree']) / stride})
+    return result
 
 
 #
@@ -68,22 +233,121 @@ def getCol(aLngInTenths, res):
 	return int(math.floor((aLngInTenths + 1800) * res/10))
 
 def getData(north, south, west, east, res, dataset):
-	result = getDataAsSequences(north, south, west, east, res, dataset)
-	result['base64String'] = ''.join(result['sequences'])
+	result = getDataAsArray(north, south, west, east, res, dataset)
+	result['base64String'] = encodeSymbols(result['values'])
 	return result
 
 def getCoordinate(row, col, res):
 	return {"lat": row * 10/res - 900, "lon": col * 10/res - 1800}
 
-def getDataAsSequences(north, south, west, east, res, dataset):
-	pointsPerRow = 360 * res
+#
+# The data for the bounding box as a 2-D numpy array of symbol values, one row
+# per latitude, in 'values'.  The block is a strided slice of the data set's grid;
+# if the box crosses the dateline (west > east) it is two slices side by side.
+# Nothing is encoded: call encodeSymbols on 'values' to get the base64 string
+#
+def getDataAsArray(north, south, west, east, res, dataset):
 	firstRow = getRow(south, res)
 	lastRow = getRow(north, res)
 	firstCol = getCol(west, res)
-	lastCol = getCol(east, res) - 1
-	sequences = [(firstCol + x * pointsPerRow, lastCol + x * pointsPerRow) for x in range(firstRow, lastRow)]
-	data = [dataset[s[0]:s[1] + 1] for s in sequences]
-	return  {'swCorner': getCoordinate(firstRow, firstCol, res), 'pointsPerRow': lastCol + 1 - firstCol, 'pointsPerDegree': res, 'sequences': data}
+	lastCol = getCol(east, res)
+	values = dataset.getBlock(firstRow, lastRow, firstCol, lastCol)
+	return  {'swCorner': getCoordinate(firstRow, firstCol, res), 'pointsPerRow': values.shape[1], 'pointsPerDegree': res, 'values': values}
+
+def getDataAsSequences(north, south, west, east, res, dataset):
+	result = getDataAsArray(north, south, west, east, res, dataset)
+	result['sequences'] = [encodeSymbols(row) for row in result['values']]
+	return result
+
+#
+# Aggregates (sum, mean, nonzero count and histogram, see aggregates.py) over the
+# cells of a bounding box, the same cells as searchDB, from the data set's
+# summed-area tables.  Records the resolution served, as searchDB does
+#
+def searchAggregate(dataManager, year, month, res, north, south, west, east, waitMs = 0):
+    dataManager.recordAccess(year, month, res)
+    servedRes, dataset = getBestAvailableData(dataManager, year, month, res, waitMs)
+    result = getAggregate(dataManager, year, month, servedRes, dataset, north, south, west, east)
+    result.update({'res': servedRes, 'requestedRes': res})
+    return result
+
+def getAggregate(dataManager, year, month, res, dataset, north, south, west, east):
+    tables = dataManager.getAggregateTables(year, month, res, dataset)
+    (firstRow, firstCol) = (getRow(south, res), getCol(west, res))
+    result = tables.getAggregate(firstRow, getRow(north, res), firstCol, getCol(east, res))
+    result.update({'swCorner': getCoordinate(firstRow, firstCol, res), 'pointsPerDegree': res})
+    return result
+
+#
+# Batches of searches.  resolveDataSets finds the data set to serve for each
+# (year, month, res) in keys once, however many searches use it: the loads of
+# the data sets which aren't loaded are all started first, so they go in
+# parallel, and waitMs is the wait for the whole batch rather than for each data
+# set.  Returns a dictionary from key to (resolution served, data set).
+# searchResolved then does one search, of kind batchKinds, with a resolved data
+# set; maxPoints strides the result but, to keep the grouping, doesn't change
+# the resolution
+#
+batchKinds = ['data', 'readable', 'rectangle', 'aggregate']
+
+def resolveDataSets(dataManager, keys, waitMs = 0):
+    keys = sorted(set(keys))
+    for (year, month, res) in keys:
+        dataManager.recordAccess(year, month, res)
+        if not dataManager.hasDataSet(year, month, res): dataManager.asynchLoad(year, month, res)
+    deadline = time.time() + waitMs / 1000.0
+    resolved = {}
+    for (year, month, res) in keys:
+        remainingMs = max(0, int((deadline - time.time()) * 1000))
+        resolved[(year, month, res)] = getBestAvailableData(dataManager, year, month, res, remainingMs)
+    return resolved
+
+def searchResolved(dataManager, key, resolved, kind, north, south, west, east, maxPoints = None):
+    (year, month, res) = key
+    (servedRes, dataset) = resolved
+    if kind == 'readable':
+        result = getDataAsSequences(north, south, west, east, servedRes, dataset)
+    elif kind == 'aggregate':
+        result = getAggregate(dataManager, year, month, servedRes, dataset, north, south, west, east)
+    else:
+        result = getDataAsArray(north, south, west, east, servedRes, dataset)
+    result.update({'res': servedRes, 'requestedRes': res, 'plannedRes': res})
+    if maxPoints is not None and kind != 'aggregate':
+        applyLevelOfDetail(result, maxPoints)
+        if kind == 'readable': result['sequences'] = [encodeSymbols(row) for row in result['values']]
+    return result
+
+#
+# The histories of the cells in rows [firstRow, lastRow) and columns [firstCol,
+# lastCol) at res, for every month the manifest has at res.  'values' is a
+# (rows x columns x months) array, and 'months' the (year, month) of each entry
+# along the last axis.  With a time series index it is one read per row;
+# without one, each month's data set is searched in turn.  'indexed' says which
+#
+def getTimeSeriesBlock(dataManager, res, firstRow, lastRow, firstCol, lastCol):
+    index = dataManager.getTimeSeriesIndex(res)
+    if index is not None:
+        (months, values) = (index.months, index.getBlock(firstRow, lastRow, firstCol, lastCol))
+    else:
+        months = sorted([(year, month) for (year, month, aRes) in dataManager.getLoadableKeys() if aRes == res])
+        blocks = [dataManager.getData(year, month, res).getBlock(firstRow, lastRow, firstCol, lastCol) for (year, month) in months]
+        values = numpy.dstack(blocks) if blocks else numpy.zeros((0, 0, 0), dtype=numpy.uint8)
+    return {'swCorner': getCoordinate(firstRow, firstCol, res), 'pointsPerRow': values.shape[1], 'pointsPerDegree': res,
+            'months': months, 'values': values, 'indexed': index is not None}
+
+#
+# The time series for the cells in a bounding box (the same cells as searchDB)
+#
+def searchTimeSeries(dataManager, res, north, south, west, east):
+    return getTimeSeriesBlock(dataManager, res, getRow(south, res), getRow(north, res), getCol(west, res), getCol(east, res))
+
+#
+# The time series for the cell containing a point
+#
+def searchTimeSeriesAt(dataManager, res, lat, lon):
+    row = min(getRow(lat, res), 180 * res - 1)
+    col = min(getCol(lon, res), 360 * res - 1)
+    return getTimeSeriesBlock(dataManager, res, row, row + 1, col, col + 1)
 
 #
 # count the number of zeros in a string
@@ -100,85 +364,18 @@ def getStats(dataManager, year, month, res, north, south, west, east):
     start = time.time()
     result = searchDB(dataManager, year, month, res, north, south, west, east)
     end = time.time()
-    nonzero = countNonZero(result['base64String'])
-    rectResult = searchDBReturnRows(dataManager, year, month, res, north, south, west, east, False)
+    nonzero = numpy.count_nonzero(result['values'])
     s1 = time.time()
-    rectangles = convertToRectangles(rectResult, False)
-    res1 = '[' + '.'.join(rectangles) + ']'
+    rectangles = getRectangleArray(result, False)
+    res1 = '[' + formatRectangles(rectangles, '.') + ']'
     e1 = time.time()
     s2 = time.time()
-    rectangles = convertToRectangles(rectResult, True)
-    res2 = '[' + '.'.join(rectangles) + ']'
+    rectangles = getRectangleArray(result, True)
+    res2 = '[' + formatRectangles(rectangles, '.') + ']'
     e2 = time.time()
     numRects = len(rectangles)
-    result = {'pts': len(result['base64String']), 'nonzero': nonzero, 'search(ms)': (end - start) * 1000}
+    result = {'pts': result['values'].size, 'nonzero': nonzero, 'search(ms)': (end - start) * 1000}
     result.update({'rectangles': numRects, 'convertTime(lat/lon)(ms)': (e1 - s1) * 1000})
     result.update({'rectangle bytes(lat/lon)': len(res1), 'converTime(indices)(ms)': (e2 - s2) * 1000})
     result.update({'rectangle bytes(indices)': len(res2)})
     return result
-
-#
-# Convert a sequence with a latitude, an increment, and a longitude into a list of
-# Rectangles
-#
-def convertSequenceToRectangles(latitude, firstLon, increment, sequence):
-    result = []
-    currentValue = sequence[0]
-    startLon  = firstLon
-    lon = firstLon
-    for index in range(1, len(sequence)):
-        if sequence[index] == currentValue:
-            lon += increment
-            continue
-        value = base64.index(currentValue)
-        if value != 0:
-            result.append('(%d,%d,%d,%d)' %  (value, latitude, startLon, lon))
-        currentValue = sequence[index]
-        lon += increment
-        startLon = lon
-    value = base64.index(sequence[-1])
-    if value != 0:
-        result.append('(%d,%d,%d,%d)' % (value, latitude, startLon, lon))
-    return result
-
-#
-# Convert a sequence with a latitude, an increment, and a longitude into a list of
-# Rectangles
-#
-def convertSequenceToSimpleRectangles(rowNum, sequence):
-    result = []
-    currentValue = sequence[0]
-    firstIndex = 0
-    for index in range(1, len(sequence)):
-        if sequence[index] == currentValue:
-            continue
-        value = base64.index(currentValue)
-        if value != 0:
-            result.append('(%d,%d,%d,%d)' % (value, rowNum, firstIndex, index))
-        currentValue = sequence[index]
-        firstIndex = index + 1
-    value = base64.index(sequence[-1])
-    if value != 0:
-        result.append('(%d,%d,%d,%d)' % (value, rowNum, firstIndex, len(sequence) - 1))
-    return result
-
-#
-# convert a search result into a set of rectangles
-#
-def convertToRectangles(aSearchResult, doIndicesOnly):
-    increment = 10/aSearchResult['pointsPerDegree']
-    firstLon = aSearchResult['swCorner']['lon']
-    lat = aSearchResult['swCorner']['lat']
-    rectangles = []
-    index = 0
-    for sequence in aSearchResult['sequences']:
-        if (doIndicesOnly):
-            rectangles.extend(convertSequenceToSimpleRectangles(index, sequence))
-        else:
-            rectangles.extend(convertSequenceToRectangles(lat, firstLon, increment, sequence))
-        lat += increment
-        ++index
-    return rectangles
-
-
-
@@ -0,0 +1,133 @@
+#
+# Polygon queries.  A GeoJSON Polygon or MultiPolygon (or a Feature or
+# FeatureCollection of them) is rasterized onto the grid at a resolution: a cell
+# is in the polygon if its centre is, by the even-odd rule over the polygon's
+# rings, so holes come out.  The fill is a scanline fill done for all edges at
+# once with numpy: every edge is crossed by the rows whose centres lie between
+# its ends, the crossings are sorted along each row, and each pair of crossings
+# covers the cells whose centres lie between them.  The parts of a MultiPolygon
+# are filled separately and unioned.  The result is a mask, kept as spans (row,
+# first column, last column) in grid indices (rows from the south pole, columns
+# from the dateline, as getRow and getCol count them).  Masks are cached, keyed
+# on the geometry and the resolution, so repeated queries for the same region
+# don't rasterize again
+#
+import json
+import hashlib
+import numpy
+from collections import OrderedDict
+from threading import Lock
+from rectangles import findRuns
+from config import maxCachedMasks
+
+class GeometryError(Exception):
+    pass
+
+masks = OrderedDict()
+masksLock = Lock()
+
+#
+# The polygons of a GeoJSON object, each a list of rings, each an n x 2 array
+# of (lon, lat).  Raises GeometryError if it isn't a (Multi)Polygon we can use
+#
+def getPolygons(geoJSON):
+    if not isinstance(geoJSON, dict) or not 'type' in geoJSON:
+        raise GeometryError('Not a GeoJSON object')
+    kind = geoJSON['type']
+    if kind == 'FeatureCollection':
+        polygons = sum([getPolygons(feature) for feature in geoJSON.get('features', [])], [])
+        if not polygons: raise GeometryError('A FeatureCollection must have at least one polygon')
+        return polygons
+    if kind == 'Feature':
+        return getPolygons(geoJSON.get('geometry'))
+    if kind == 'Polygon':
+        polygons = [geoJSON.get('coordinates')]
+    elif kind == 'MultiPolygon':
+        polygons = geoJSON.get('coordinates')
+    else:
+        raise GeometryError('Geometry must be a Polygon or MultiPolygon, not %s' % kind)
+    try:
+        result = [[numpy.array(ring, dtype=numpy.float64)[:, :2] for ring in polygon] for polygon in polygons]
+    except (TypeError, ValueError, IndexError):
+        raise GeometryError('Bad coordinates in %s' % kind)
+    if not result:
+        raise GeometryError('A %s must have at least one polygon' % kind)
+    if not all(result):
+        raise GeometryError('A polygon must have at least one ring')
+    result = [[closeRing(ring) for ring in polygon] for polygon in result]
+    for ring in sum(result, []):
+        if len(ring) < 4:
+            raise GeometryError('A ring must have at least four positions')
+        if not (numpy.isfinite(ring).all() and (numpy.abs(ring[:, 0]) <= 180).all() and (numpy.abs(ring[:, 1]) <= 90).all()):
+            raise GeometryError('Longitudes must be in [-180, 180] and latitudes in [-90, 90]')
+    return result
+
+#
+# GeoJSON rings end where they start; a ring which doesn't is closed here, since
+# the scanline fill needs every ring closed to cross each row an even number of times
+#
+def closeRing(ring):
+    if ring.ndim != 2 or len(ring) == 0:
+        raise GeometryError('A ring must be a list of positions')
+    if (ring[0] != ring[-1]).any(): ring = numpy.vstack([ring, ring[:1]])
+    return ring
+
+#
+# The spans of cells at res whose centres are inside one polygon, as arrays of
+# rows, first columns and last columns (inclusive).  Coordinates are scaled to
+# grid units, so the centre of cell (row, col) is (col + 0.5, row + 0.5)
+#
+def fillPolygon(rings, res):
+    edges = numpy.vstack([numpy.column_stack([ring[:-1], ring[1:]]) for ring in rings])
+    (x0, y0, x1, y1) = [(edges[:, i] + offset) * res for (i, offset) in enumerate([180, 90, 180, 90])]
+    (low, high) = (numpy.minimum(y0, y1), numpy.maximum(y0, y1))
+    firstRows = numpy.ceil(low - 0.5).astype(numpy.int64)
+    counts = numpy.maximum(numpy.ceil(high - 0.5).astype(numpy.int64) - firstRows, 0)
+    edgeIndex = numpy.repeat(numpy.arange(len(edges)), counts)
+    rows = numpy.repeat(firstRows, counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    (ex0, ey0, ex1, ey1) = (x0[edgeIndex], y0[edgeIndex], x1[edgeIndex], y1[edgeIndex])
+    crossings = ex0 + (rows + 0.5 - ey0) * (ex1 - ex0) / (ey1 - ey0)
+    order = numpy.lexsort((crossings, rows))
+    (rows, crossings) = (rows[order], crossings[order])
+    if len(rows) and (numpy.bincount(rows - rows.min()) % 2).any():
+        raise GeometryError('A row of the polygon has an odd number of edge crossings')
+    firstCols = numpy.ceil(crossings[0::2] - 0.5).astype(numpy.int64)
+    lastCols = numpy.ceil(crossings[1::2] - 0.5).astype(numpy.int64) - 1
+    return (rows[0::2], firstCols, lastCols)
+
+#
+# The mask of the polygons at res, as spans (rows, first columns, last columns)
+# sorted by row and column, without overlaps: the union of the polygons
+#
+def rasterize(polygons, res):
+    spans = [fillPolygon(rings, res) for rings in polygons]
+    rows = numpy.concatenate([span[0] for span in spans])
+    firstCols = numpy.clip(numpy.concatenate([span[1] for span in spans]), 0, 360 * res - 1)
+    lastCols = numpy.clip(numpy.concatenate([span[2] for span in spans]), 0, 360 * res - 1)
+    keep = (firstCols <= lastCols) & (rows >= 0) & (rows < 180 * res)
+    (rows, firstCols, lastCols) = (rows[keep], firstCols[keep], lastCols[keep])
+    if len(rows) == 0: return (rows, firstCols, lastCols)
+    firstRow = rows.min()
+    coverage = numpy.zeros((rows.max() - firstRow + 1, 360 * res + 1), dtype=numpy.int32)
+    numpy.add.at(coverage, (rows - firstRow, firstCols), 1)
+    numpy.add.at(coverage, (rows - firstRow, lastCols + 1), -1)
+    inside = numpy.cumsum(coverage, axis=1)[:, :-1] > 0
+    (maskRows, maskFirstCols, maskLastCols, runValues) = findRuns(inside)
+    isInside = runValues == 1
+    return (maskRows[isInside] + firstRow, maskFirstCols[isInside], maskLastCols[isInside])
+
+#
+# The mask for a GeoJSON object at res, from the cache if we have it.  Raises
+# GeometryError for bad geometry
+#
+def getMask(geoJSON, res):
+    key = (hashlib.sha1(json.dumps(geoJSON, sort_keys=True)).hexdigest(), res)
+    with masksLock:
+        if key in masks:
+            masks[key] = masks.pop(key)
+            return masks[key]
+    mask = rasterize(getPolygons(geoJSON), res)
+    with masksLock:
+        masks[key] = mask
+        while len(masks) > maxCachedMasks: masks.popitem(last=False)
+    return mask
@@ -0,0 +1,102 @@
+#
+# Recent popularity of the data sets, used to decide the order in which the
+# DataManager warms up at startup.  Each (year, month, res) has a score which
+# goes up by one on every access and decays with a half-life of
+# popularityHalfLifeDays.  The scores are saved to popularity.json in the data
+# directory (every popularitySaveInterval seconds, if they have changed) so they
+# survive a restart.  The saves are done by a PopularitySaver thread, so no
+# request waits on the disk
+#
+import os
+import json
+import time
+from threading import Thread, Lock
+from config import popularityHalfLifeDays, popularitySaveInterval
+
+#
+# The thread which saves a PopularityTracker's scores every popularitySaveInterval
+# seconds, when there have been accesses since the last save
+#
+class PopularitySaver(Thread):
+    def __init__(self, tracker):
+        Thread.__init__(self)
+        self.daemon = True
+        self.tracker = tracker
+
+    def run(self):
+        while True:
+            time.sleep(popularitySaveInterval)
+            if self.tracker.isDirty(): self.tracker.save()
+
+class PopularityTracker:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lock = Lock()
+        self.halfLife = popularityHalfLifeDays * 24 * 3600.0
+        self.scores = {}
+        self.dirty = False
+        self.load()
+        self.saver = PopularitySaver(self)
+        self.saver.start()
+
+    #
+    # Read the saved scores.  A missing or unreadable file just means no history
+    #
+    def load(self):
+        try:
+            f = open(self.fileName)
+            records = json.loads(f.read())
+            f.close()
+        except (IOError, ValueError):
+            return
+        for record in records:
+            key = (record['year'], record['month'], record['res'])
+            self.scores[key] = (record['score'], record['time'])
+
+    #
+    # Write the scores, atomically so a crash can't leave a half-written file
+    #
+    def save(self):
+        with self.lock:
+            records = [{'year': year, 'month': month, 'res': res, 'score': score, 'time': when}
+                       for ((year, month, res), (score, when)) in self.scores.items()]
+            self.dirty = False
+        try:
+            f = open(self.fileName + '.tmp', 'w')
+            f.write(json.dumps(records))
+            f.close()
+            os.rename(self.fileName + '.tmp', self.fileName)
+        except IOError as e:
+            print 'Failed to save popularity to %s: %s' % (self.fileName, e)
+
+    def isDirty(self):
+        with self.lock:
+            return self.dirty
+
+    def decayedScore(self, key, now):
+        if not key in self.scores: return 0.0
+        (score, when) = self.scores[key]
+        return score * 0.5 ** ((now - when) / self.halfLife)
+
+    #
+    # Called by the DataManager for every search.  The scores are saved later, by
+    # the PopularitySaver
+    #
+    def recordAccess(self, year, month, res, wasLoaded):
+        key = (year, month, res)
+        now = time.time()
+        with self.lock:
+            self.scores[key] = (self.decayedScore(key, now) + 1, now)
+            self.dirty = True
+
+    def getScore(self, year, month, res):
+        with self.lock:
+            return self.decayedScore((year, month, res), time.time())
+
+    #
+    # The popularity of a month: the sum of the scores of its resolutions
+    #
+    def getMonthScore(self, year, month):
+        with self.lock:
+            now = time.time()
+            return sum([self.decayedScore(key, now) for key in self.scores if key[0] == year and key[1] == month])
@@ -0,0 +1,108 @@
+#
+# Predictive prefetch for the data manager.  The front end animates through
+# months and zooms in through the resolutions, so when a user looks at
+# (year, month, res) the data sets they are most likely to want next are the
+# previous and next months at res, and the next finer resolution for the month.
+# The Prefetcher listens to the accesses the search functions record with the
+# DataManager and loads those neighbours at PRIORITY_PREFETCH, so user loads
+# always go first.  Prefetching never takes the loaded bytes over
+# prefetchMemoryFraction of the memory budget, so it does not push out data sets
+# users are looking at.  When the user moves on, queued prefetches which are not
+# neighbours of the latest access are cancelled
+#
+from threading import Lock
+from mapping import fullSetSize
+from loadManager import PRIORITY_PREFETCH
+from config import prefetchMemoryFraction
+
+resolutions = [1, 2, 4, 10]
+
+class Prefetcher:
+    def __init__(self, dataManager):
+        self.dataManager = dataManager
+        self.lock = Lock()
+        # data sets loaded by prefetching which no user has asked for yet
+        self.prefetched = set()
+        # prefetches issued which have not finished loading
+        self.outstanding = {}
+        self.stats = {'accesses': 0, 'hits': 0, 'misses': 0, 'issued': 0, 'cancelled': 0, 'skippedForBudget': 0}
+        months = set([(year, month) for (year, month, res) in dataManager.getLoadableKeys()])
+        self.months = sorted(months)
+
+    #
+    # The (year, month) before and after (year, month) in the manifest
+    #
+    def adjacentMonths(self, year, month):
+        if not (year, month) in self.months: return []
+        index = self.months.index((year, month))
+        return [self.months[i] for i in [index - 1, index + 1] if i >= 0 and i < len(self.months)]
+
+    #
+    # The data sets to prefetch after an access to (year, month, res): the
+    # adjacent months at res, then the next finer resolution for this month
+    #
+    def getTargets(self, year, month, res):
+        targets = [(aYear, aMonth, res) for (aYear, aMonth) in self.adjacentMonths(year, month)]
+        finer = [aRes for aRes in resolutions if aRes > res]
+        if finer: targets.append((year, month, finer[0]))
+        return [key for key in targets if self.dataManager.checkLoadable(*key)]
+
+    #
+    # Called by the DataManager for every search.  wasLoaded says whether the
+    # requested data set was loaded when it was asked for
+    #
+    def recordAccess(self, year, month, res, wasLoaded):
+        key = (year, month, res)
+        with self.lock:
+            self.stats['accesses'] += 1
+            self.collectFinished()
+            if wasLoaded and key in self.prefetched:
+                self.stats['hits'] += 1
+                self.prefetched.discard(key)
+            elif not wasLoaded:
+                self.stats['misses'] += 1
+                self.prefetched.discard(key)
+                # a user is now waiting for it
+                if key in self.outstanding: del self.outstanding[key]
+            targets = self.getTargets(year, month, res)
+            for stale in [aKey for aKey in self.outstanding if not aKey in targets]:
+                if self.dataManager.cancelLoad(stale[0], stale[1], stale[2], PRIORITY_PREFETCH):
+                    self.stats['cancelled'] += 1
+                    del self.outstanding[stale]
+            for target in targets: self.prefetch(target)
+
+    #
+    # Move finished prefetches from outstanding to prefetched
+    #
+    def collectFinished(self):
+        for (key, future) in self.outstanding.items():
+            if not future.done(): continue
+            del self.outstanding[key]
+            if future.error is None: self.prefetched.add(key)
+
+    #
+    # Start a prefetch, unless the data set is loaded or being loaded, or it would
+    # take us over the prefetch budget
+    #
+    def prefetch(self, key):
+        if key in self.outstanding or self.dataManager.hasDataSet(*key): return
+        budget = self.dataManager.memoryBudget * prefetchMemoryFraction
+        if self.dataManager.getSize() + fullSetSize(key[2]) * 3 / 4 > budget:
+            self.stats['skippedForBudget'] += 1
+            return
+        self.outstanding[key] = self.dataManager.asynchLoad(key[0], key[1], key[2], PRIORITY_PREFETCH)
+        self.stats['issued'] += 1
+
+    #
+    # Prefetch statistics.  hitRate is the fraction of requests for a data set
+    # which wasn't loaded by the user's own earlier requests that prefetching covered
+    #
+    def getStats(self):
+        with self.lock:
+            self.collectFinished()
+            result = dict(self.stats)
+            result['outstanding'] = len(self.outstanding)
+            result['unused'] = len(self.prefetched)
+            lookups = self.stats['hits'] + self.stats['misses']
+            result['hitRate'] = float(self.stats['hits']) / lookups if lookups else 0.0
+            return result
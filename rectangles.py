@@ -0,0 +1,158 @@
+#
+# Convert search results into rectangles: one rectangle per run of equal,
+# nonzero values in a row.  A rectangle is a 4-tuple (value, latitude, first
+# longitude, last longitude), in tenths of degrees, where the longitudes are
+# those of the first and last cells in the run; or, for indicesOnly, (value,
+# row, first column, last column) with the row and columns counted from the
+# south-west corner of the search.  The runs are found for the whole block at
+# once with numpy, and the rectangles are formatted with a single % operation.
+#
+# Rectangles can optionally be merged across rows, in which case each is a
+# 5-tuple: the 4-tuple for its southernmost row followed by the latitude (or
+# row) of its northernmost row.  merge='rows' joins runs in consecutive rows
+# with the same value and the same columns, which is vectorized and cheap;
+# merge='greedy' covers the nonzero cells with rectangles grown greedily (as
+# wide as the run, then as far north as the whole width allows), which gives
+# fewer rectangles on smooth fields but is a Python loop over the rectangles
+#
+import numpy
+from mapping import symbolValues
+
+rectangleFormat = '(%d,%d,%d,%d)'
+mergedRectangleFormat = '(%d,%d,%d,%d,%d)'
+mergeModes = ['rows', 'greedy']
+
+#
+# The 2-D array of symbol values for a search result.  Results from the search
+# functions carry it in 'values'; otherwise we decode the 'sequences', one row
+# per sequence
+#
+def getValues(aSearchResult):
+    if 'values' in aSearchResult: return aSearchResult['values']
+    rows = [symbolValues[numpy.frombuffer(sequence, dtype=numpy.uint8)] for sequence in aSearchResult['sequences']]
+    if len(rows) == 0: return numpy.zeros((0, 0), dtype=numpy.uint8)
+    return numpy.vstack(rows)
+
+#
+# Find the maximal runs of equal values in each row of a 2-D array.  Returns
+# four arrays, one entry per run in row-major order: the row, the first and last
+# columns (inclusive) and the value.  Every row starts a run, so the run ending
+# before the next run start never spills into the next row
+#
+def findRuns(values):
+    if values.size == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, empty, empty)
+    numCols = values.shape[1]
+    isStart = numpy.ones(values.shape, dtype=bool)
+    isStart[:, 1:] = values[:, 1:] != values[:, :-1]
+    starts = numpy.flatnonzero(isStart)
+    ends = numpy.append(starts[1:], values.size) - 1
+    return (starts / numCols, starts % numCols, ends % numCols, values.ravel()[starts].astype(numpy.int64))
+
+#
+# Join runs into rectangles across rows: a run continues the rectangle of the run
+# in the previous row if the two have the same value and columns.  Sorting the
+# runs by (value, columns, row) puts each such chain together, so a chain starts
+# wherever the key changes or the row doesn't follow on.  Returns the first and
+# last rows, first and last columns and values of the rectangles, sorted by
+# first row and then column
+#
+def mergeRuns(rows, firstCols, lastCols, runValues):
+    if len(rows) == 0: return (rows, rows, firstCols, lastCols, runValues)
+    order = numpy.lexsort((rows, lastCols, firstCols, runValues))
+    (rows, firstCols, lastCols, runValues) = (rows[order], firstCols[order], lastCols[order], runValues[order])
+    continues = numpy.zeros(len(rows), dtype=bool)
+    continues[1:] = ((runValues[1:] == runValues[:-1]) & (firstCols[1:] == firstCols[:-1]) &
+                     (lastCols[1:] == lastCols[:-1]) & (rows[1:] == rows[:-1] + 1))
+    chainStarts = numpy.flatnonzero(~continues)
+    chainEnds = numpy.append(chainStarts[1:], len(rows)) - 1
+    result = (rows[chainStarts], rows[chainEnds], firstCols[chainStarts], lastCols[chainStarts], runValues[chainStarts])
+    order = numpy.lexsort((result[2], result[0]))
+    return tuple([column[order] for column in result])
+
+#
+# Greedy rectangle cover of the nonzero cells.  Take the runs in row-major order;
+# for each stretch of a run not already covered, grow a rectangle north for as
+# long as the whole stretch has the run's value and is uncovered.  Returns the
+# same arrays as mergeRuns
+#
+def greedyCover(values, rows, firstCols, lastCols, runValues):
+    covered = numpy.zeros(values.shape, dtype=bool)
+    numRows = values.shape[0]
+    result = []
+    for (row, firstCol, lastCol, value) in zip(rows.tolist(), firstCols.tolist(), lastCols.tolist(), runValues.tolist()):
+        uncovered = ~covered[row, firstCol:lastCol + 1]
+        if not uncovered.any(): continue
+        edges = numpy.diff(numpy.concatenate([[0], uncovered.astype(numpy.int8), [0]]))
+        for (start, stop) in zip(numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)):
+            (first, last) = (firstCol + start, firstCol + stop - 1)
+            lastRow = row
+            while (lastRow + 1 < numRows and (values[lastRow + 1, first:last + 1] == value).all()
+                   and not covered[lastRow + 1, first:last + 1].any()):
+                lastRow += 1
+            covered[row:lastRow + 1, first:last + 1] = True
+            result.append((row, lastRow, first, last, value))
+    if len(result) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return (empty, empty, empty, empty, empty)
+    columns = numpy.array(result, dtype=numpy.int64)
+    return tuple([columns[:, i] for i in range(5)])
+
+#
+# The rectangles for a search result as an n x 4 integer array, or, if merge is
+# one of mergeModes, an n x 5 array of merged rectangles.  rowOffset is the row of
+# the search result the values start at, for results handled a chunk of rows at a time
+#
+def getRectangleArray(aSearchResult, doIndicesOnly, merge = None, rowOffset = 0):
+    values = getValues(aSearchResult)
+    (rows, firstCols, lastCols, runValues) = findRuns(values)
+    rows = rows + rowOffset
+    nonZero = runValues != 0
+    (rows, firstCols, lastCols, runValues) = (rows[nonZero], firstCols[nonZero], lastCols[nonZero], runValues[nonZero])
+    lastRows = None
+    if merge == 'rows':
+        (rows, lastRows, firstCols, lastCols, runValues) = mergeRuns(rows, firstCols, lastCols, runValues)
+    elif merge == 'greedy':
+        (rows, lastRows, firstCols, lastCols, runValues) = greedyCover(values, rows - rowOffset, firstCols, lastCols, runValues)
+        (rows, lastRows) = (rows + rowOffset, lastRows + rowOffset)
+    elif merge is not None:
+        raise ValueError('Unknown merge %s, expected one of %s' % (merge, ', '.join(mergeModes)))
+    if doIndicesOnly:
+        columns = [runValues, rows, firstCols, lastCols]
+        if lastRows is not None: columns.append(lastRows)
+        return numpy.column_stack(columns)
+    firstLon = aSearchResult['swCorner']['lon']
+    lat = aSearchResult['swCorner']['lat']
+    columns = [runValues, lat + getOffsets(rows, aSearchResult), firstLon + getOffsets(firstCols, aSearchResult),
+               firstLon + getOffsets(lastCols, aSearchResult)]
+    if lastRows is not None: columns.append(lat + getOffsets(lastRows, aSearchResult))
+    return numpy.column_stack(columns)
+
+#
+# The offsets, in tenths of degrees, of rows or columns of a search result from
+# its south-west corner.  A strided result (see applyLevelOfDetail) has
+# res / stride points per degree, which need not be whole, so its offsets are
+# worked out from the stride and rounded down
+#
+def getOffsets(indices, aSearchResult):
+    stride = aSearchResult.get('stride', 1)
+    if stride == 1: return indices * (10/aSearchResult['pointsPerDegree'])
+    return indices * 10 * stride / aSearchResult['res']
+
+#
+# Format an array of rectangles (4- or 5-tuples) as a single string, the
+# rectangles separated by separator
+#
+def formatRectangles(rectangles, separator = ','):
+    if len(rectangles) == 0: return ''
+    format = rectangleFormat if rectangles.shape[1] == 4 else mergedRectangleFormat
+    return separator.join([format] * len(rectangles)) % tuple(rectangles.ravel().tolist())
+
+#
+# convert a search result into a list of rectangles, each formatted as a string
+#
+def convertToRectangles(aSearchResult, doIndicesOnly, merge = None):
+    rectangles = getRectangleArray(aSearchResult, doIndicesOnly, merge)
+    format = rectangleFormat if merge is None else mergedRectangleFormat
+    return [format % tuple(rectangle) for rectangle in rectangles.tolist()]
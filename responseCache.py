@@ -0,0 +1,66 @@
+#
+# In-process cache of data responses.  Identical queries (the same data set,
+# resolution and bounding box, in tenths of degrees, and the same route
+# arguments) get the same body, so rather than search, join and serialize again
+# we keep the bodies of recent responses.  The cache is an LRU bounded by the
+# bytes of body it holds.  Only responses at the requested resolution are
+# cached: one served at a fallback resolution is replaced once the requested
+# resolution loads.  ETags for the responses come from makeETag: they are strong,
+# derived from the data set's version, the query and the content encoding, so a
+# client's copy stays valid exactly as long as the data set is unchanged
+#
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from config import responseCacheBytes
+
+#
+# The ETag (without the quotes) for the response to key, a normalized query, from
+# the data set at version, sent with encoding (None for uncompressed)
+#
+def makeETag(key, version, encoding = None):
+    tag = hashlib.sha1(repr((version, key))).hexdigest()[:32]
+    if encoding is not None: tag += '-' + encoding
+    return tag
+
+class ResponseCache:
+    def __init__(self, maxBytes = responseCacheBytes):
+        self.maxBytes = maxBytes
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    #
+    # The cached (body, mimetype, headers) for key, or None
+    #
+    def get(self, key):
+        with self.lock:
+            if not key in self.entries:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return entry
+
+    #
+    # Cache the body, with its mimetype and headers, under key, and drop the
+    # least recently used bodies until we are back within budget
+    #
+    def put(self, key, body, mimetype, headers):
+        if len(body) > self.maxBytes: return
+        with self.lock:
+            if key in self.entries: self.size -= len(self.entries.pop(key)[0])
+            self.entries[key] = (body, mimetype, headers)
+            self.size += len(body)
+            while self.size > self.maxBytes:
+                (oldKey, oldEntry) = self.entries.popitem(last=False)
+                self.size -= len(oldEntry[0])
+                self.stats['evictions'] += 1
+
+    def getStats(self):
+        with self.lock:
+            result = dict(self.stats)
+            result.update({'entries': len(self.entries), 'bytes': self.size, 'maxBytes': self.maxBytes})
+            return result
@@ -8,15 +8,15 @@ from os import listdir
 from os.path import isfile, join
 from config import dataDirectory
 from loadManager import DataManager
+from rectangles import convertToRectangles
 
 
-offsetComputers = {
-    4: OffsetComputer(4, [0, 2, 4, 7, 9]),
-    2: OffsetComputer(2, [0, 5]),
-    1: OffsetComputer(1, [9]),
-    10: OffsetComputer(10, range(0, 10))
-}
 
+#
+# A data set's key, for messages
+#
+def convertToString(year, month, res):
+    return 'year=%d, month=%d, res=%d' % (year, month, res)
 
 #
 # Utility to check that a query is OK.  This should be called
@@ -38,32 +38,46 @@ def checkQuery(dataManager, year, month, res, nwLat, seLat, nwLon, seLon):
 #
 # Pull the dataset from the data manager, returning either the data set with the
 # requested resolution, or, if that is not available but loadable, the best loaded
-# resolution and kick off the load request so the next request for this data will hit
+# resolution and kick off the load request so the next request for this data will hit.
+# waitMs is the policy for a miss: wait up to waitMs milliseconds for the requested
+# resolution to load before falling back to the best loaded resolution (0, the
+# default, falls back immediately).  If nothing is loaded for the month we wait for
+# the requested resolution.  Returns the pair (resolution served, dataset)
 #
-def getBestAvailableData(dataManager, year, month, res):
+def getBestAvailableData(dataManager, year, month, res, waitMs = 0):
     if dataManager.hasDataSet(year, month, res):
         return res, dataManager.getData(year, month, res)
-    bestRes = dataManager.bestResolution(year, month)
-    result = dataManager.getData(year, month, bestRes)
     if dataManager.checkLoadable(year, month, res):
-        dataManager.asynchLoad(year, month, res)
-    return bestRes, result
+        future = dataManager.asynchLoad(year, month, res)
+        if waitMs > 0 and future.wait(waitMs / 1000.0) and future.error is None:
+            return res, future.dataset
+    bestRes = dataManager.bestResolution(year, month)
+    if bestRes is None:
+        return res, dataManager.getData(year, month, res)
+    return bestRes, dataManager.getData(year, month, bestRes)
 #
 # Actually Search the DB for a matching string.  No checking: call first if
-# you want this checked.  Result is a String, row-major order
-#
-def searchDB(dataManager, year, month, res, north, south, west, east):
-    res, dataSet = getBestAvailableData(dataManager, year, month, res)
-    return getData(north, south, west, east, offsetComputers[res], dataSet)
+# you want this checked.  Result is a String, row-major order.  The result
+# records the resolution served in 'res' and the one asked for in 'requestedRes'
+#
+def searchDB(dataManager, year, month, res, north, south, west, east, waitMs = 0):
+    dataManager.recordAccess(year, month, res)
+    servedRes, dataSet = getBestAvailableData(dataManager, year, month, res, waitMs)
+    result = getData(north, south, west, east, offsetComputers[servedRes], dataSet)
+    result.update({'res': servedRes, 'requestedRes': res})
+    return result
 
 
 #
 # Actually Search the DB for a matching string.  No checking: call first if
 # you want this checked.  Result is a list of sequences, one per row
 #
-def searchDBReturnRows(dataManager, year, month, res, north, south, west, east, optimizeSingleRectangleCase):
-    res, dataSet = getBestAvailableData(dataManager, year, month, res)
-    return getDataAsSequences(north, south, west, east, offsetComputers[res], dataSet, optimizeSingleRectangleCase)
+def searchDBReturnRows(dataManager, year, month, res, north, south, west, east, optimizeSingleRectangleCase, waitMs = 0):
+    dataManager.recordAccess(year, month, res)
+    servedRes, dataSet = getBestAvailableData(dataManager, year, month, res, waitMs)
+    result = getDataAsSequences(north, south, west, east, offsetComputers[servedRes], dataSet, optimizeSingleRectangleCase)
+    result.update({'res': servedRes, 'requestedRes': res})
+    return result
 
 #
 # count the number of zeros in a string
@@ -96,66 +110,3 @@ def getStats(dataManager, year, month, res, north, south, west, east):
     result.update({'rectangle bytes(lat/lon)': len(res1), 'converTime(indices)(ms)': (e2 - s2) * 1000})
     result.update({'rectangle bytes(indices)': len(res2)})
     return result
-
-#
-# Convert a sequence with a latitude, an increment, and a longitude into a list of
-# Rectangles
-#
-def convertSequenceToRectangles(latitude, firstLon, increment, sequence):
-    result = []
-    currentValue = sequence[0]
-    startLon  = firstLon
-    lon = firstLon
-    for index in range(1, len(sequence)):
-        if sequence[index] == currentValue:
-            lon += increment
-            continue
-        value = base64.index(currentValue)
-        if value != 0:
-            result.append('(%d,%d,%d,%d)' %  (value, latitude, startLon, lon))
-        currentValue = sequence[index]
-        lon += increment
-        startLon = lon
-    value = base64.index(sequence[-1])
-    if value != 0:
-        result.append('(%d,%d,%d,%d)' % (value, latitude, startLon, lon))
-    return result
-
-#
-# Convert a sequence with a latitude, an increment, and a longitude into a list of
-# Rectangles
-#
-def convertSequenceToSimpleRectangles(rowNum, sequence):
-    result = []
-    currentValue = sequence[0]
-    firstIndex = 0
-    for index in range(1, len(sequence)):
-        if sequence[index] == currentValue:
-            continue
-        value = base64.index(currentValue)
-        if value != 0:
-            result.append('(%d,%d,%d,%d)' % (value, rowNum, firstIndex, index))
-        currentValue = sequence[index]
-        firstIndex = index + 1
-    value = base64.index(sequence[-1])
-    if value != 0:
-        result.append('(%d,%d,%d,%d)' % (value, rowNum, firstIndex, len(sequence) - 1))
-    return result
-
-#
-# convert a search result into a set of rectangles
-#
-def convertToRectangles(aSearchResult, doIndicesOnly):
-    increment = 10/aSearchResult['pointsPerDegree']
-    firstLon = aSearchResult['swCorner']['lon']
-    lat = aSearchResult['swCorner']['lat']
-    rectangles = []
-    index = 0
-    for sequence in aSearchResult['sequences']:
-        if (doIndicesOnly):
-            rectangles.extend(convertSequenceToSimpleRectangles(index, sequence))
-        else:
-            rectangles.extend(convertSequenceToRectangles(lat, firstLon, increment, sequence))
-        lat += increment
-        ++index
-    return rectangles
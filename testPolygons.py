@@ -0,0 +1,80 @@
+#!/usr/bin/python
+from polygons import getPolygons, rasterize, GeometryError
+import numpy
+
+# Polygons are given as (lon, lat) in degrees: a concave polygon with a hole,
+# and a MultiPolygon of two triangles, one of them near the dateline
+polygonTests = [
+    {'type': 'Polygon', 'coordinates': [
+        [[-100.3, 20.7], [-60.2, 25.1], [-80.6, 35.4], [-55.9, 50.2], [-105.1, 45.3], [-100.3, 20.7]],
+        [[-90.4, 30.2], [-75.3, 33.6], [-85.2, 40.1], [-90.4, 30.2]]]},
+    {'type': 'MultiPolygon', 'coordinates': [
+        [[[10.1, -30.2], [40.7, -10.4], [20.3, 15.9], [10.1, -30.2]]],
+        [[[150.2, 60.3], [179.6, 62.1], [170.4, 80.2], [150.2, 60.3]]]]}
+]
+
+emptyGeometries = [
+    {'type': 'Polygon', 'coordinates': []},
+    {'type': 'MultiPolygon', 'coordinates': []},
+    {'type': 'MultiPolygon', 'coordinates': [[]]},
+    {'type': 'FeatureCollection', 'features': []}
+]
+
+resolutions = [1, 2, 4]
+
+#
+# The mask as a 180 * res x 360 * res array of booleans, from its spans
+#
+def maskToGrid(mask, res):
+    grid = numpy.zeros((180 * res, 360 * res), dtype=bool)
+    for (row, firstCol, lastCol) in zip(*mask):
+        grid[row, firstCol:lastCol + 1] = True
+    return grid
+
+#
+# Point in polygon for every cell centre at res, by the even-odd rule over the
+# rings of each polygon, unioned over the polygons
+#
+def bruteForceGrid(polygons, res):
+    lons = (numpy.arange(360 * res) + 0.5) / res - 180
+    lats = (numpy.arange(180 * res) + 0.5) / res - 90
+    (x, y) = numpy.meshgrid(lons, lats)
+    grid = numpy.zeros(x.shape, dtype=bool)
+    for rings in polygons:
+        inside = numpy.zeros(x.shape, dtype=bool)
+        for ring in rings:
+            for ((x0, y0), (x1, y1)) in zip(ring[:-1], ring[1:]):
+                crosses = (y0 > y) != (y1 > y)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    xCross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+                inside ^= crosses & (x < xCross)
+        grid |= inside
+    return grid
+
+def testMask(geoJSON, res):
+    polygons = getPolygons(geoJSON)
+    mismatches = (maskToGrid(rasterize(polygons, res), res) != bruteForceGrid(polygons, res)).sum()
+    print ('%s at res %d: %d cells differ from point in polygon' % (geoJSON['type'], res, mismatches))
+    return mismatches == 0
+
+def testOpenRing(geoJSON, res):
+    openJSON = {'type': 'Polygon', 'coordinates': [ring[:-1] for ring in geoJSON['coordinates']]}
+    closed = rasterize(getPolygons(geoJSON), res)
+    opened = rasterize(getPolygons(openJSON), res)
+    same = all([(a == b).all() for (a, b) in zip(closed, opened)])
+    print ('Open rings at res %d: %s' % (res, 'same mask as closed rings' if same else 'different mask'))
+    return same
+
+def testEmpty(geoJSON):
+    try:
+        getPolygons(geoJSON)
+    except GeometryError as e:
+        print ('%s: GeometryError %s' % (geoJSON, e))
+        return True
+    print ('%s: no GeometryError' % geoJSON)
+    return False
+
+results = [testMask(geoJSON, res) for geoJSON in polygonTests for res in resolutions]
+results += [testOpenRing(polygonTests[0], res) for res in resolutions]
+results += [testEmpty(geoJSON) for geoJSON in emptyGeometries]
+print ('%d of %d checks passed' % (sum(results), len(results)))
@@ -0,0 +1,90 @@
+#
+# XYZ map tiles.  A tile is tileSize x tileSize pixels of the Web Mercator
+# projection at zoom z, column x (from the dateline, going east) and row y (from
+# the north edge, going south).  Tiles are rendered from the data set at the
+# coarsest resolution with at least one point per pixel at the zoom, or res 10
+# past that.  Each pixel takes the cell its centre falls in, found with the same
+# row and column rule as getRow and getCol in newSearch, and its symbol is
+# colored through palette.  Symbol 0 (no pollution) is transparent.  The PNG is
+# indexed color, written with zlib and struct only
+#
+import math
+import struct
+import zlib
+import numpy
+from config import tileSize, compressionLevel
+
+resolutions = [1, 2, 4, 10]
+pngSignature = '\x89PNG\r\n\x1a\n'
+
+#
+# Color ramp for symbols 1 to 63, from pale yellow through orange and red to
+# purple, as (symbol, (r, g, b)) anchors which are interpolated between
+#
+paletteAnchors = [(1, (255, 255, 178)), (16, (254, 178, 76)), (32, (240, 59, 32)), (48, (189, 0, 38)), (63, (84, 39, 143))]
+
+def makePalette(anchors):
+    symbols = numpy.arange(64)
+    anchorSymbols = [symbol for (symbol, color) in anchors]
+    channels = [numpy.interp(symbols, anchorSymbols, [color[i] for (symbol, color) in anchors]) for i in range(3)]
+    return numpy.round(numpy.column_stack(channels)).astype(numpy.uint8)
+
+palette = makePalette(paletteAnchors)
+transparency = numpy.array([0] + [255] * 63, dtype=numpy.uint8)
+
+#
+# The resolution to render tiles at zoom z from: the coarsest with at least as
+# many points per degree as the tile has pixels per degree of longitude
+#
+def resolutionForZoom(z):
+    pixelsPerDegree = tileSize * 2 ** z / 360.0
+    for res in resolutions:
+        if res >= pixelsPerDegree: return res
+    return resolutions[-1]
+
+def isValidTile(z, x, y):
+    return z >= 0 and x >= 0 and y >= 0 and x < 2 ** z and y < 2 ** z
+
+#
+# The longitudes of the centres of the pixel columns, and latitudes of the
+# centres of the pixel rows, of tile (z, x, y), in degrees
+#
+def getPixelCoordinates(z, x, y):
+    numTiles = 2 ** z
+    pixels = (numpy.arange(tileSize) + 0.5) / tileSize
+    lons = (x + pixels) / numTiles * 360.0 - 180.0
+    lats = numpy.degrees(numpy.arctan(numpy.sinh(math.pi * (1 - 2 * (y + pixels) / numTiles))))
+    return (lons, lats)
+
+#
+# The symbol values of the tile's pixels, a tileSize x tileSize array with the
+# northernmost row first.  Only the block of the data set under the tile is read
+#
+def getTileValues(dataset, res, z, x, y):
+    (lons, lats) = getPixelCoordinates(z, x, y)
+    rows = numpy.clip(numpy.floor((lats + 90) * res).astype(numpy.int64), 0, 180 * res - 1)
+    cols = numpy.clip(numpy.floor((lons + 180) * res).astype(numpy.int64), 0, 360 * res - 1)
+    (firstRow, firstCol) = (rows.min(), cols.min())
+    block = dataset.getBlock(firstRow, rows.max() + 1, firstCol, cols.max() + 1)
+    return block[(rows - firstRow)[:, numpy.newaxis], (cols - firstCol)[numpy.newaxis, :]]
+
+def makeChunk(chunkType, data):
+    return struct.pack('>I', len(data)) + chunkType + data + struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff)
+
+#
+# An indexed-color PNG of a 2-D array of symbol values, colored through palette
+#
+def encodePNG(values):
+    (height, width) = values.shape
+    scanlines = numpy.zeros((height, width + 1), dtype=numpy.uint8)
+    scanlines[:, 1:] = numpy.minimum(values, 63)
+    header = struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)
+    return (pngSignature + makeChunk('IHDR', header) + makeChunk('PLTE', palette.tostring()) +
+            makeChunk('tRNS', transparency.tostring()) +
+            makeChunk('IDAT', zlib.compress(scanlines.tostring(), compressionLevel)) + makeChunk('IEND', ''))
+
+#
+# The PNG for tile (z, x, y) of a data set at res
+#
+def renderTile(dataset, res, z, x, y):
+    return encodePNG(getTileValues(dataset, res, z, x, y))
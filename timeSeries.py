@@ -0,0 +1,131 @@
+#
+# Time-major index of the data sets at one resolution.  The monthly data set
+# files are space-major: one file per (year, month), so the history of one cell
+# is a byte in each of a couple of hundred files.  The index turns that around:
+# for every cell (in the usual row-major order, from the dateline east, from
+# the south pole north) it holds the cell's symbol value for every month in the
+# index, one byte per month, contiguously.  The history of a cell is then one
+# contiguous read, and the histories of a row of cells are one read too.  The
+# file is the header, the table of months, then the cells, and is opened with
+# mmap.  At res 10 it is 6.48 million bytes per month, so it is built once (with
+# buildTimeSeriesIndex, see makeBase64DB.buildTimeSeries) rather than by the server.
+# The months table records the version of each month's data set (see
+# DataManager.getVersion) the index was built from, so an index which a rebuilt
+# data set has made stale is noticed and not used
+#
+import os
+import mmap
+import struct
+import hashlib
+import numpy
+from datasetFile import DataSetFormatError
+from mapping import fullSetSize
+
+#
+# The header: magic, format version, res, number of months, number of cells,
+# little-endian, 12 bytes.  Each entry of the months table is (year, month, SHA-1
+# of the data set version) in 24 bytes
+#
+magic = 'PM2T'
+formatVersion = 2
+headerFormat = '<4sBBHI'
+headerSize = struct.calcsize(headerFormat)
+monthFormat = '<HBx20s'
+monthSize = struct.calcsize(monthFormat)
+
+#
+# Cell-months gathered in memory at a time while building
+#
+buildBlockBytes = 64 * 1000 * 1000
+
+def timeSeriesFileName(directory, res):
+    return '%s/timeseries_%d.bin' % (directory, res)
+
+def versionDigest(version):
+    return hashlib.sha1(str(version)).digest()
+
+#
+# Write the index for res.  months is the sorted list of (year, month) to index,
+# versions the version of each month's data set, and openMonth(year, month)
+# returns the month's data set at res.  The index is built a block of rows at a
+# time: each month's rows are read (sequentially), interleaved into cell-major
+# order and appended.  The file appears atomically
+#
+def buildTimeSeriesIndex(months, versions, openMonth, res, fileName):
+    numCells = fullSetSize(res)
+    (numRows, rowLength) = (180 * res, 360 * res)
+    dataSets = [openMonth(year, month) for (year, month) in months]
+    rowsPerBlock = max(1, buildBlockBytes / (rowLength * max(len(months), 1)))
+    f = open(fileName + '.tmp', 'wb')
+    f.write(struct.pack(headerFormat, magic, formatVersion, res, len(months), numCells))
+    f.write(''.join([struct.pack(monthFormat, year, month, versionDigest(version))
+                     for ((year, month), version) in zip(months, versions)]))
+    for firstRow in range(0, numRows, rowsPerBlock):
+        lastRow = min(firstRow + rowsPerBlock, numRows)
+        block = numpy.empty(((lastRow - firstRow) * rowLength, len(months)), dtype=numpy.uint8)
+        for (i, dataset) in enumerate(dataSets):
+            block[:, i] = dataset.getBlock(firstRow, lastRow, 0, rowLength).ravel()
+        f.write(block.tostring())
+    f.close()
+    for dataset in dataSets: dataset.close()
+    os.rename(fileName + '.tmp', fileName)
+
+class TimeSeriesIndex:
+    def __init__(self, storage, res, months, versions):
+        self.storage = storage
+        self.res = res
+        self.months = months
+        self.versions = versions
+        self.numRows = 180 * res
+        self.rowLength = 360 * res
+        self.offset = headerSize + monthSize * len(months)
+
+    #
+    # The index as a 3-D (rows x columns x months) array, a view of the mapping
+    #
+    def getCube(self):
+        cells = numpy.frombuffer(self.storage, dtype=numpy.uint8, count=fullSetSize(self.res) * len(self.months), offset=self.offset)
+        return cells.reshape(self.numRows, self.rowLength, len(self.months))
+
+    #
+    # The histories of the cells in rows [firstRow, lastRow) and columns
+    # [firstCol, lastCol), as a (rows x columns x months) array.  Clamped to the
+    # grid; if firstCol > lastCol the block crosses the dateline, as for DataSet.getBlock
+    #
+    def getBlock(self, firstRow, lastRow, firstCol, lastCol):
+        firstRow = max(firstRow, 0)
+        lastRow = max(min(lastRow, self.numRows), firstRow)
+        firstCol = min(max(firstCol, 0), self.rowLength)
+        lastCol = min(max(lastCol, 0), self.rowLength)
+        cube = self.getCube()
+        if firstCol > lastCol:
+            return numpy.hstack([cube[firstRow:lastRow, firstCol:], cube[firstRow:lastRow, :lastCol]])
+        return numpy.array(cube[firstRow:lastRow, firstCol:lastCol])
+
+    def close(self):
+        self.storage.close()
+
+#
+# Open an index file.  Raises DataSetFormatError if it isn't one, or is truncated
+#
+def openTimeSeriesIndex(fileName):
+    f = open(fileName, 'rb')
+    try:
+        storage = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    if len(storage) < headerSize:
+        storage.close()
+        raise DataSetFormatError('File %s too short for a header' % fileName)
+    (fileMagic, version, res, numMonths, numCells) = struct.unpack(headerFormat, storage[:headerSize])
+    if fileMagic != magic or version != formatVersion or numCells != fullSetSize(res):
+        storage.close()
+        raise DataSetFormatError('File %s is not a version %d time series index' % (fileName, formatVersion))
+    table = storage[headerSize:headerSize + monthSize * numMonths]
+    months = [struct.unpack(monthFormat, table[i * monthSize:(i + 1) * monthSize]) for i in range(numMonths)]
+    index = TimeSeriesIndex(storage, res, [(year, month) for (year, month, digest) in months],
+                            [digest for (year, month, digest) in months])
+    if len(storage) < index.offset + numCells * numMonths:
+        storage.close()
+        raise DataSetFormatError('File %s is truncated' % fileName)
+    return index